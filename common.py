@@ -1,5 +1,8 @@
 """Variables and functions used throughout the codebase"""
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
 import os
 
 import pandas as pd
@@ -26,6 +29,38 @@ def get_data_path(data_type:str, data_stage:str):
     return data_path
 
 
+def select_samples(processed_path:str, sample_list:str=None, pattern:str=None,
+                   shard_index:int=None, num_shards:int=None):
+    """Select processed sample files by a sample list, a glob pattern and a shard
+
+    :param processed_path: path to the processed samples
+    :type processed_path: str
+    :param sample_list: optional file with one "{source} {sample_id}" per line
+    :type sample_list: str
+    :param pattern: optional glob pattern matched against "{source} {sample_id}"
+    :type pattern: str
+    :param shard_index: which shard of the selected samples to keep, starting at 0
+    :type shard_index: int
+    :param num_shards: the number of shards to split the selected samples into
+    :type num_shards: int
+    :return: the selected file names, "{source} {sample_id}.csv", sorted
+    :rtype: list
+    """
+    file_names = sorted(x for x in os.listdir(processed_path) if x.endswith(".csv") and x != "payoff.csv")
+    if sample_list is not None:
+        with open(sample_list, encoding="UTF-8") as f:
+            listed = {x.strip().removesuffix(".csv") for x in f if x.strip() != ""}
+        missing = listed - {x[:-4] for x in file_names}
+        if len(missing) > 0:
+            print(f"{len(missing)} listed samples are not in {processed_path}: {', '.join(sorted(missing))}")
+        file_names = [x for x in file_names if x[:-4] in listed]
+    if pattern is not None:
+        file_names = [x for x in file_names if fnmatch(x[:-4], pattern)]
+    if num_shards is not None:
+        file_names = file_names[shard_index::num_shards]
+    return file_names
+
+
 def read_payoff_df(processed_data_path:str):
     """Read the payoff csv and format for downstream usage
 
@@ -65,3 +100,39 @@ def calculate_game(a:float, b:float, c:float, d:float):
     else:
         game = "Unknown"
     return game
+
+
+def _apply_to_chunk(function, chunk):
+    return [function(item) for item in chunk]
+
+
+def parallel_map(function, items, workers:int=1, chunk_size:int=1):
+    """Apply a function to each item, in a pool of worker processes if workers > 1
+
+    Items are submitted in chunks and at most two chunks per worker are in flight,
+    so only a bounded number of results is held in memory before being consumed.
+
+    :param function: picklable function of one item
+    :type function: callable
+    :param items: the items to process
+    :type items: list
+    :param workers: number of worker processes
+    :type workers: int
+    :param chunk_size: number of items sent to a worker per task
+    :type chunk_size: int
+    :return: generator of the function results, in the same order as items
+    :rtype: generator
+    """
+    if workers <= 1:
+        for item in items:
+            yield function(item)
+        return
+    chunks = (items[i:i+chunk_size] for i in range(0, len(items), chunk_size))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_apply_to_chunk, function, chunk))
+            if len(pending) >= 2*workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
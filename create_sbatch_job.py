@@ -2,6 +2,7 @@
 
 Expected usage:
 python3 spatial_egt/create_sbatch_job.py email name time memory conda_env path (node)
+    (--samples FILE --tasks N) (--cpus-per-task C)
 
 Where:
 email: email for notification of failed jobs
@@ -11,14 +12,49 @@ memory: job memory limit with unit (eg 4gb)
 conda_env: the conda environment name
 path: the full path to the code
 node: optional, the buy-in node to run jobs on
+--samples, --tasks: optional, make a job array of N tasks over the sample list FILE
+    (one "{source} {sample_id}" per line), split into N contiguous shards in out/{name}/shards
+    each task runs the submitted command once with --samples set to its shard
+--cpus-per-task: optional, cpus for each job or task, also passed to array tasks as --workers
+
+Submit a job array with the command and arguments to run on each shard, eg
+sbatch job_{name}.sb -m spatial_egt.data_processing.processed_to_domain data_type Patches
+
+The same shards can be run without a cluster, with a subprocess per task:
+python3 spatial_egt/create_sbatch_job.py local name cpus_per_task (parallel_tasks) -- command...
 """
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
+import subprocess
 import sys
+import time
+
+
+def task_arguments(name, task_id, cpus):
+    """Arguments added to the command of an array task to run its shard"""
+    return ["--samples", f"out/{name}/shards/{task_id}.txt", "--workers", str(cpus)]
+
+
+def write_shards(name, samples, num_tasks):
+    """Split the sample list into contiguous shards of about equal size, one per task"""
+    with open(samples, encoding="UTF-8") as f:
+        sample_ids = [x.strip() for x in f if x.strip() != ""]
+    num_tasks = max(1, min(num_tasks, len(sample_ids)))
+    shard_path = f"out/{name}/shards"
+    if not os.path.exists(shard_path):
+        os.makedirs(shard_path)
+    for task_id in range(num_tasks):
+        start = task_id*len(sample_ids)//num_tasks
+        stop = (task_id+1)*len(sample_ids)//num_tasks
+        with open(f"{shard_path}/{task_id}.txt", "w", encoding="UTF-8") as f:
+            f.writelines(f"{x}\n" for x in sample_ids[start:stop])
+    return num_tasks
 
 
-def sbatch(email, name, time, memory, conda_env, path, node):
-    """Generate sbatch script str"""
+def sbatch(email, name, time, memory, conda_env, path, node, num_tasks=None, cpus=None):
+    """Generate sbatch script str, as a job array if num_tasks is given"""
     sbatch_script = [
         "#!/bin/bash --login",
         "#SBATCH --mail-type=FAIL",
@@ -31,22 +67,76 @@ def sbatch(email, name, time, memory, conda_env, path, node):
         f"cd {path}",
         "python3 $*",
     ]
+    if cpus is not None:
+        sbatch_script.insert(7, f"#SBATCH --cpus-per-task={cpus}")
+    if num_tasks is not None:
+        sbatch_script[4] = f"#SBATCH -o out/{name}/%A_%a.out"
+        sbatch_script.insert(5, f"#SBATCH --array=0-{num_tasks-1}")
+        task_cpus = "${SLURM_CPUS_PER_TASK:-1}"
+        sbatch_script[-1] = " ".join(["python3 $*"] + task_arguments(name, "$SLURM_ARRAY_TASK_ID", task_cpus))
     if node is not None:
         sbatch_script.insert(1, f"#SBATCH -A {node}")
     return "\n".join(sbatch_script)
 
 
-def main(email, name, time, memory, conda_env, path, node=None):
+def main(email, name, time, memory, conda_env, path, node=None, samples=None, num_tasks=None,
+         cpus=None):
     """Generate and save sbatch script based on input arguments"""
-    script = sbatch(email, name, time, memory, conda_env, path, node)
+    if samples is not None:
+        num_tasks = write_shards(name, samples, num_tasks)
+    script = sbatch(email, name, time, memory, conda_env, path, node, num_tasks, cpus)
     if not os.path.exists(f"out/{name}"):
         os.makedirs(f"out/{name}")
     with open(f"job_{name}.sb", "w", encoding="UTF-8") as f:
         f.write(script)
 
 
+def run_task(name, command, cpus, task_id):
+    """Run the command on one shard, returning the exit code and seconds taken"""
+    start = time.perf_counter()
+    with open(f"out/{name}/local_{task_id}.out", "w", encoding="UTF-8") as f:
+        result = subprocess.run([sys.executable] + command + task_arguments(name, task_id, cpus),
+                                stdout=f, stderr=subprocess.STDOUT, check=False)
+    return result.returncode, time.perf_counter() - start
+
+
+def run_local(name, command, cpus=1, parallel_tasks=1):
+    """Run the command on every shard of out/{name}/shards, like the tasks of the job array
+
+    The output of each task is written to out/{name}/local_{task}.out.
+    """
+    shard_path = f"out/{name}/shards"
+    task_ids = sorted(int(x[:-4]) for x in os.listdir(shard_path) if x.endswith(".txt"))
+    with ThreadPoolExecutor(max_workers=parallel_tasks) as executor:
+        results = executor.map(lambda task_id: run_task(name, command, cpus, task_id), task_ids)
+        failed = []
+        for task_id, (returncode, seconds) in zip(task_ids, results):
+            print(f"Task {task_id}: exit code {returncode}, {seconds:.1f}s")
+            if returncode != 0:
+                failed.append(task_id)
+    if len(failed) > 0:
+        print(f"{len(failed)} tasks failed: {', '.join(str(x) for x in failed)}")
+    return failed
+
+
 if __name__ == "__main__":
-    if len(sys.argv) in (7, 8):
-        main(*sys.argv[1:])
-    else:
-        print("Please see the module docstring for usage instructions.")
+    if len(sys.argv) > 1 and sys.argv[1] == "local":
+        if "--" in sys.argv and sys.argv.index("--") in (4, 5):
+            split = sys.argv.index("--")
+            parallel = int(sys.argv[4]) if split == 5 else 1
+            run_local(sys.argv[2], sys.argv[split+1:], int(sys.argv[3]), parallel)
+        else:
+            print("Please see the module docstring for usage instructions.")
+        sys.exit()
+    parser = argparse.ArgumentParser(usage="Please see the module docstring for usage instructions.")
+    for argument in ("email", "name", "time", "memory", "conda_env", "path"):
+        parser.add_argument(argument)
+    parser.add_argument("node", nargs="?")
+    parser.add_argument("--samples")
+    parser.add_argument("--tasks", type=int)
+    parser.add_argument("--cpus-per-task", type=int)
+    args = parser.parse_args()
+    if (args.samples is None) != (args.tasks is None):
+        parser.error("Please provide both a sample list and a number of tasks for a job array.")
+    main(args.email, args.name, args.time, args.memory, args.conda_env, args.path, args.node,
+         args.samples, args.tasks, args.cpus_per_task)
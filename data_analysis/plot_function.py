@@ -5,6 +5,8 @@ import pandas as pd
 import seaborn as sns
 
 from spatial_egt.common import game_colors, get_data_path
+from spatial_egt.data_processing.ragged import RaggedStatistic
+from spatial_egt.data_processing.statistic_store import load_statistic
 from spatial_database import DISTRIBUTION_BINS, FUNCTION_LABELS
 
 
@@ -69,10 +71,36 @@ def get_data(df_func, func_name, data_type, source="", sample_ids=None):
     return df
 
 
+def samples_long_df(statistic, source, sample_ids):
+    """One row per value of the given samples, read without loading the rest of the statistic"""
+    frames = []
+    for sample_id in sample_ids:
+        try:
+            values = statistic.get(source, sample_id)
+        except KeyError:
+            print(f"No {statistic.name} for {source} {sample_id}.")
+            continue
+        frames.append(pd.DataFrame({"source":source, "sample":sample_id,
+                                    statistic.name:np.asarray(values)}))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=["source", "sample", statistic.name])
+    return pd.concat(frames, ignore_index=True)
+
+
+def long_df(statistic, func_name, source=None, sample_ids=None):
+    """One row per value of the statistic, only for the given samples if any are given"""
+    if isinstance(statistic, RaggedStatistic):
+        if sample_ids:
+            return samples_long_df(statistic, source, sample_ids)
+        return statistic.to_long_df()
+    df_func = statistic.explode(func_name)
+    df_func[func_name] = df_func[func_name].astype(float)
+    return df_func
+
+
 def idv_plots(df_func, func_name, title, xlabel, ylabel, plot, data_type, source, *sample_ids):
     save_loc = get_data_path(data_type, f"images/{func_name}")
     df = get_data(df_func, func_name, data_type, source=source, sample_ids=sample_ids)
-    df = df.explode(func_name)
     file_name = func_name+"_"+source+"_"+"_".join(sample_ids)
     plot(df, func_name, save_loc, file_name, title, xlabel, ylabel, "sample")
 
@@ -80,7 +108,6 @@ def idv_plots(df_func, func_name, title, xlabel, ylabel, plot, data_type, source
 def agg_plot(df_func, func_name, title, xlabel, ylabel, plot, data_type, source):
     save_loc = get_data_path(data_type, f"images/{func_name}")
     df = get_data(df_func, func_name, data_type, source=source)
-    df = df.explode(func_name)
     plot(df, func_name, save_loc, func_name+source, title, xlabel, ylabel, "game")
 
 
@@ -88,9 +115,12 @@ def main():
     data_type = sys.argv[1]
     func_name = sys.argv[2]
 
-    features_data_path = get_data_path(data_type, "features")
-    df_func = pd.read_pickle(f"{features_data_path}/{func_name}.pkl")
-    function_type = df_func["type"].iloc[0]
+    statistics_data_path = get_data_path(data_type, "statistics")
+    statistic = load_statistic(statistics_data_path, func_name)
+    if isinstance(statistic, RaggedStatistic):
+        function_type = statistic.type
+    else:
+        function_type = statistic["type"].iloc[0]
     if function_type == "distribution":
         plot = plot_dists
     elif function_type == "function":
@@ -103,13 +133,16 @@ def main():
     title = func_name.replace("_", " ")
 
     if len(sys.argv) == 3:
+        df_func = long_df(statistic, func_name)
         agg_plot(df_func, func_name, title, xlabel, ylabel, plot, data_type, "")
     elif len(sys.argv) == 4:
         source = sys.argv[3]
+        df_func = long_df(statistic, func_name)
         agg_plot(df_func, func_name, title, xlabel, ylabel, plot, data_type, source)
     elif len(sys.argv) > 4:
         source = sys.argv[3]
         sample_ids = sys.argv[4:]
+        df_func = long_df(statistic, func_name, source, sample_ids)
         idv_plots(df_func, func_name, title, xlabel, ylabel, plot, data_type, source, *sample_ids)
 
 
@@ -3,9 +3,9 @@ import sys
 from matplotlib.colors import ListedColormap
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 
 from common import game_colors, get_data_path
+from spatial_egt.data_processing.spatial_statistics.sample import read_sample
 
 
 def downsample(s_coords, r_coords, ideal_size=(25,20)):
@@ -77,7 +77,7 @@ def main(data_type, source, *sample_ids):
     image_data_path = get_data_path(data_type, "images")
     for sample_id in sample_ids:
         file_name = f"{source} {sample_id}.csv"
-        df_sample = pd.read_csv(f"{processed_data_path}/{file_name}")
+        df_sample = read_sample(processed_data_path, file_name).to_df()
         plot_sample(df_sample, image_data_path, sample_id)
 
 
@@ -1,23 +1,66 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
-import sys
 
 import pandas as pd
 
 from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.statistic_store import save_statistic
 
 
-def main(data_type, statistic_name):
-    save_loc = get_data_path(data_type, "statistics")
+def read_shard(path):
+    """Read a per-sample statistic shard, returning None if it cannot be read"""
+    try:
+        return pd.read_pickle(path)
+    except Exception as e:
+        print(f"Error: {path}")
+        print(e)
+        return None
+
+
+def main(data_type, statistic_name, workers=8, delete=False, stage="statistics"):
+    save_loc = get_data_path(data_type, stage)
     statistics_path = f"{save_loc}/{statistic_name}"
-    df = pd.DataFrame()
-    for file_name in os.listdir(statistics_path):
-        df_sample = pd.read_pickle(f"{statistics_path}/{file_name}")
-        df = pd.concat([df, df_sample])
-    df.to_pickle(f"{save_loc}/{statistic_name}.pkl")
+    processed_path = get_data_path(data_type, "processed")
+    expected = {x[:-4] for x in os.listdir(processed_path) if x != "payoff.csv"}
+    if not os.path.isdir(statistics_path):
+        print(f"No shards to combine for {statistic_name}.")
+        return
+    shard_names = sorted(x[:-4] for x in os.listdir(statistics_path) if x.endswith(".pkl"))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shards = list(executor.map(read_shard, [f"{statistics_path}/{x}.pkl" for x in shard_names]))
+    corrupt = [name for name, shard in zip(shard_names, shards) if shard is None]
+    missing = sorted(expected - set(shard_names))
+    if len(corrupt) > 0:
+        print(f"{len(corrupt)} corrupt shards: {', '.join(corrupt)}")
+    if len(missing) > 0:
+        print(f"{len(missing)} samples have no shard: {', '.join(missing)}")
+
+    shards_read = [shard for shard in shards if shard is not None]
+    if len(shards_read) == 0:
+        print(f"No shards to combine for {statistic_name}.")
+        return
+    df = pd.concat(shards_read, ignore_index=True)
+    save_statistic(df, save_loc, statistic_name)
+    print(f"Combined {len(df)} samples into {statistic_name}.")
+
+    if delete:
+        for name, shard in zip(shard_names, shards):
+            if shard is not None:
+                os.remove(f"{statistics_path}/{name}.pkl")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        main(sys.argv[1], sys.argv[2])
-    else:
-        print("Please provide the data type and statistic name.")
+    parser = argparse.ArgumentParser(description="Combine per-sample statistic shards.")
+    parser.add_argument("data_type", help="the parent data dir")
+    parser.add_argument("statistic_name", help="the statistic whose shards to combine")
+    parser.add_argument("--workers", type=int, default=8, help="number of threads reading shards")
+    parser.add_argument("--delete", action="store_true",
+                        help="delete the shards that were combined "
+                             "(incremental runs will then recalculate them)")
+    parser.add_argument("--approximate", action="store_true",
+                        help="combine shards of approximate statistics in statistics_approx")
+    args = parser.parse_args()
+    stage = "statistics_approx" if args.approximate else "statistics"
+    main(args.data_type, args.statistic_name, args.workers, args.delete, stage)
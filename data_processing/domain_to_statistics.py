@@ -1,39 +1,76 @@
+import argparse
+from functools import partial
 import os
-import sys
 
 import muspan as ms
-import pandas as pd
-from pandas.api.types import is_object_dtype
 
-from spatial_egt.common import get_data_path
+from spatial_egt.common import get_data_path, parallel_map
+from spatial_egt.data_processing.profiling import profile_path, profiled, write_profile
+from spatial_egt.data_processing.spatial_statistics.sample import read_sample
+from spatial_egt.data_processing.statistic_store import save_statistic, statistic_df
 from spatial_database import DOMAIN_STATISTIC_REGISTRY
 
 
-def main(data_type, domain_name):
+def domain_statistics(domain_data_path, domain_file, processed_path=None, profile=None):
+    """Load one domain and calculate every domain statistic on it
+
+    If profile is the path of a profile log, the resources used by each statistic are
+    appended to it, with the cell counts of the domain's processed sample.
+    """
+    try:
+        domain = ms.io.load_domain(f"{domain_data_path}/{domain_file}",
+                                   print_metadata=False, print_summary=False)
+    except Exception as e:
+        print(f"Error: {domain_file}")
+        print(e)
+        return dict()
+    source = domain_file.split(" ")[0]
+    sample = domain_file.split(" ")[1][:-7]
+    cell_counts = dict()
+    if profile is not None:
+        cell_counts = read_sample(processed_path, f"{domain_file[:-7]}.csv").counts
+    rows = dict()
+    records = []
+    for statistic_name, statistic_func in DOMAIN_STATISTIC_REGISTRY.items():
+        try:
+            with profiled(records, statistic_name, statistic_func, domain_file[:-7], cell_counts, dict()):
+                statistic = statistic_func(domain)
+        except Exception as e:
+            print(f"Error: {statistic_name} {domain_file}")
+            print(e)
+            continue
+        rows[statistic_name] = {"source":source, "sample":sample, statistic_name:statistic}
+    write_profile(profile, records)
+    return rows
+
+
+def main(data_type, domain_name, workers=1, profile=False):
     statistics_data_path = get_data_path(data_type, "statistics")
     domain_data_path = f"{statistics_data_path}/{domain_name}"
+    domain_files = sorted(x for x in os.listdir(domain_data_path) if x.endswith(".muspan"))
+    chunk_size = max(1, min(16, len(domain_files)//(4*workers)))
+    profile = profile_path(data_type) if profile else None
+    calculation = partial(domain_statistics, domain_data_path,
+                          processed_path=get_data_path(data_type, "processed"), profile=profile)
+    rows = {statistic_name:[] for statistic_name in DOMAIN_STATISTIC_REGISTRY}
+    for domain_rows in parallel_map(calculation, domain_files, workers, chunk_size):
+        for statistic_name, row in domain_rows.items():
+            rows[statistic_name].append(row)
     for statistic_name, statistic_func in DOMAIN_STATISTIC_REGISTRY.items():
-        rows = []
-        for domain_file in os.listdir(domain_data_path):
-            domain = ms.io.load_domain(f"{domain_data_path}/{domain_file}",
-                                       print_metadata=False, print_summary=False)
-            statistic = statistic_func(domain)
-            source = domain_file.split(" ")[0]
-            sample = domain_file.split(" ")[1][:-7]
-            rows.append({"source":source, "sample":sample, statistic_name:statistic})
-        df = pd.DataFrame(rows)
-        if is_object_dtype(df[statistic_name]):
-            if statistic_func.__name__.endswith("dist"):
-                df["type"] = "distribution"
-            else:
-                df["type"] = "function"
-        else:
-            df["type"] = "value"
-        df.to_pickle(f"{statistics_data_path}/{statistic_name}.pkl")
+        if len(rows[statistic_name]) == 0:
+            print(f"No domains calculated {statistic_name}.")
+            continue
+        df = statistic_df(rows[statistic_name], statistic_name, statistic_func)
+        save_statistic(df, statistics_data_path, statistic_name)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        main(sys.argv[1], sys.argv[2])
-    else:
-        print("Please provide the data type and domain calculation function name.")
+    parser = argparse.ArgumentParser(description="Calculate the domain statistics of saved domains.")
+    parser.add_argument("data_type", help="the parent data dir")
+    parser.add_argument("domain_name", help="domain calculation function name")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--profile", action="store_true",
+                        help="append the time and memory used by each statistic to "
+                             "data/{data_type}/statistics/profile.jsonl (see profiling)")
+    args = parser.parse_args()
+    main(args.data_type, args.domain_name, args.workers, args.profile)
@@ -0,0 +1,72 @@
+"""Manifest of calculated outputs, used to skip up-to-date work when rerunning"""
+
+import hashlib
+import json
+import os
+
+from spatial_egt.data_processing.spatial_statistics.sample import file_stamp
+
+
+def parameter_hash(function, params):
+    """Hash of a calculation function and its parameters"""
+    description = [f"{function.__module__}.{function.__qualname__}", params]
+    description = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.blake2b(description.encode(), digest_size=8).hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Record of (statistic, parameter hash, sample) -> input file hash and output location
+
+    Entries are appended to a JSON lines file and flushed as soon as each output is
+    written, so a killed run can resume where it stopped. A truncated last line from
+    a killed run is ignored, and later entries override earlier ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.input_hashes = {}
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="UTF-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                key = (entry["statistic"], entry["parameters"], entry["sample"])
+                self.entries[key] = entry
+                self.input_hashes[entry["sample"]] = (entry["input_stamp"], entry["input"])
+
+    def input_hash(self, sample, input_path):
+        """Hash of the input file, reusing the recorded hash if the file size and mtime are unchanged"""
+        stamp = file_stamp(input_path)
+        if sample in self.input_hashes and self.input_hashes[sample][0] == stamp:
+            return self.input_hashes[sample][1]
+        input_hash = file_hash(input_path)
+        self.input_hashes[sample] = (stamp, input_hash)
+        return input_hash
+
+    def is_current(self, statistic, parameters, sample, input_hash):
+        """Whether the output for this statistic and sample exists and was made from the same input"""
+        entry = self.entries.get((statistic, parameters, sample))
+        if entry is None:
+            return False
+        return entry["input"] == input_hash and os.path.exists(entry["output"])
+
+    def record(self, statistic, parameters, sample, input_hash, output):
+        entry = {"statistic":statistic, "parameters":parameters, "sample":sample,
+                 "input":input_hash, "input_stamp":self.input_hashes[sample][0], "output":output}
+        with open(self.path, "a", encoding="UTF-8") as f:
+            f.write(json.dumps(entry)+"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[(statistic, parameters, sample)] = entry
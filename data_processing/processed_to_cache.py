@@ -0,0 +1,43 @@
+"""Build the binary cache of the processed samples.
+
+Expected usage:
+python3 -m spatial_egt.data_processing.processed_to_cache data_type (--workers W)
+
+Where:
+data_type: the parent data dir
+--workers: optional, number of worker processes
+
+Once data/{data_type}/processed_cache exists, every reader of processed samples
+memory-maps the cached arrays instead of parsing the csv, and rebuilds entries
+whose csv has changed.
+"""
+
+import argparse
+from functools import partial
+import os
+
+from spatial_egt.common import get_data_path, parallel_map
+from spatial_egt.data_processing.spatial_statistics.sample import get_cache_path, read_sample
+
+
+def cache_sample(processed_path, file_name):
+    """Create or refresh the cache entry of one sample"""
+    sample = read_sample(processed_path, file_name)
+    return len(sample)
+
+
+def main(data_type, workers=1):
+    """Cache every processed sample"""
+    processed_path = get_data_path(data_type, "processed")
+    os.makedirs(get_cache_path(processed_path), exist_ok=True)
+    file_names = [x for x in os.listdir(processed_path) if x != "payoff.csv"]
+    num_cells = sum(parallel_map(partial(cache_sample, processed_path), file_names, int(workers)))
+    print(f"Cached {len(file_names)} samples ({num_cells} cells).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="Please see the module docstring for usage instructions.")
+    parser.add_argument("data_type")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    main(args.data_type, args.workers)
@@ -1,30 +1,90 @@
-import sys
+import argparse
+from functools import partial
+import time
 
 import muspan as ms
-import pandas as pd
 
-from spatial_egt.common import get_data_path
+from spatial_egt.common import get_data_path, parallel_map, select_samples
+from spatial_egt.data_processing.manifest import Manifest, parameter_hash
+from spatial_egt.data_processing.spatial_statistics.domain_cache import DOMAIN_CACHE
+from spatial_egt.data_processing.spatial_statistics.sample import read_sample
 from spatial_database import DOMAIN_PARAMS, DOMAIN_REGISTRY
 
 
-def main(data_type, statistic_name, source, sample):
-    print(source, sample)
-    processed_path = get_data_path(data_type, "processed")
+def build_domain(processed_path, statistics_path, statistic_name, statistic_args, file_name):
+    """Calculate and save the domain of one sample, returning the seconds taken (None on error)
+
+    Domains are built once per sample here, so they are dropped from the in-memory domain
+    cache afterwards instead of holding the last few large domains in every worker.
+    """
+    start = time.perf_counter()
+    try:
+        spatial_sample = read_sample(processed_path, file_name)
+        domain = DOMAIN_REGISTRY[statistic_name](spatial_sample, **statistic_args)
+        ms.io.save_domain(domain, path_to_save=statistics_path, name_of_file=file_name[:-4])
+    except Exception as e:
+        print(f"Error: {file_name}")
+        print(e)
+        return None
+    finally:
+        DOMAIN_CACHE.clear()
+    return time.perf_counter() - start
 
-    statistic_calculation = DOMAIN_REGISTRY[statistic_name]
-    statistic_args_datatype = DOMAIN_PARAMS[data_type]
-    statistic_args = {}
-    if statistic_name in statistic_args_datatype:
-        statistic_args = statistic_args_datatype[statistic_name]
 
-    df_sample = pd.read_csv(f"{processed_path}/{source} {sample}.csv")
-    domain = statistic_calculation(df_sample, **statistic_args)
+def main(data_type, statistic_name, file_names, incremental=False, workers=1):
+    processed_path = get_data_path(data_type, "processed")
+    statistic_args = DOMAIN_PARAMS[data_type].get(statistic_name, dict())
     statistics_path = get_data_path(data_type, f"statistics/{statistic_name}")
-    ms.io.save_domain(domain, path_to_save=statistics_path, name_of_file=f"{source} {sample}")
+
+    if incremental:
+        manifest = Manifest(f"{get_data_path(data_type, 'statistics')}/manifest.jsonl")
+        parameters = parameter_hash(DOMAIN_REGISTRY[statistic_name], statistic_args)
+        input_hashes = dict()
+        for file_name in file_names:
+            input_hash = manifest.input_hash(file_name[:-4], f"{processed_path}/{file_name}")
+            if not manifest.is_current(statistic_name, parameters, file_name[:-4], input_hash):
+                input_hashes[file_name] = input_hash
+        print(f"{len(file_names)-len(input_hashes)} of {len(file_names)} domains are up to date.")
+        file_names = list(input_hashes)
+
+    start = time.perf_counter()
+    build = partial(build_domain, processed_path, statistics_path, statistic_name, statistic_args)
+    sample_times = []
+    for file_name, seconds in zip(file_names, parallel_map(build, file_names, workers)):
+        if seconds is None:
+            continue
+        print(f"{file_name[:-4]}: {seconds:.2f}s")
+        sample_times.append(seconds)
+        if incremental:
+            manifest.record(statistic_name, parameters, file_name[:-4], input_hashes[file_name],
+                            f"{statistics_path}/{file_name[:-4]}.muspan")
+    if len(file_names) > 1:
+        print(f"Built {len(sample_times)} of {len(file_names)} domains in "
+              f"{time.perf_counter()-start:.1f}s ({sum(sample_times):.1f}s in samples).")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 5:
-        main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+    parser = argparse.ArgumentParser(
+        description="Calculate and save the domains of processed samples: "
+                    "one sample, or a batch selected by list, glob and shard (all samples by default).")
+    parser.add_argument("data_type", help="the parent data dir")
+    parser.add_argument("statistic_name", help="domain calculation function name")
+    parser.add_argument("source", nargs="?", help="source of the sample, if building one sample")
+    parser.add_argument("sample", nargs="?", help="sample id, if building one sample")
+    parser.add_argument("--samples", help="file listing one \"{source} {sample_id}\" per line")
+    parser.add_argument("--glob", help="glob pattern matched against \"{source} {sample_id}\"")
+    parser.add_argument("--shard", type=int, nargs=2, metavar=("INDEX", "NUM_SHARDS"),
+                        help="only build every NUM_SHARDS-th selected sample, starting at INDEX")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip samples whose domain is up to date in the manifest")
+    args = parser.parse_args()
+    if (args.source is None) != (args.sample is None):
+        parser.error("Please provide both a source and sample id, if building one sample.")
+    if args.source is not None:
+        file_names = [f"{args.source} {args.sample}.csv"]
     else:
-        print("Please provide the data type, domain calculation function name, source and sample id.")
+        shard_index, num_shards = (None, None) if args.shard is None else args.shard
+        file_names = select_samples(get_data_path(args.data_type, "processed"),
+                                    args.samples, args.glob, shard_index, num_shards)
+    main(args.data_type, args.statistic_name, file_names, args.incremental, args.workers)
@@ -1,69 +1,251 @@
+import argparse
+from functools import partial
+import inspect
 import os
-import sys
 
-from pandas.api.types import is_object_dtype
-import pandas as pd
-
-from spatial_egt.common import get_data_path
+from spatial_egt.common import get_data_path, parallel_map, select_samples
+from spatial_egt.data_processing import combine_sample_statistics
+from spatial_egt.data_processing.manifest import Manifest, parameter_hash
+from spatial_egt.data_processing.profiling import profile_path, profiled, write_profile
+from spatial_egt.data_processing.statistic_store import save_statistic, statistic_df
+from spatial_egt.data_processing.spatial_statistics.approximate import APPROXIMATIONS
+from spatial_egt.data_processing.spatial_statistics.domain_cache import DOMAIN_CACHE
+from spatial_egt.data_processing.spatial_statistics.sample import read_sample
+from spatial_egt.data_processing.spatial_statistics.sweeps import (calculate_sweep, sweep_names,
+                                                                  sweep_parameter)
 from spatial_database import STATISTIC_PARAMS, STATISTIC_REGISTRY
 
 
-def calculate_statistics(processed_path, file_names, statistic_name, statistic_calculation, statistic_args):
-    rows = []
-    for file_name in file_names:
-        if file_name == "payoff.csv":
-            continue
-        df_sample = pd.read_csv(f"{processed_path}/{file_name}")
+def get_statistic_names(statistic_name):
+    """Expand "all" or a comma-separated list into registered statistic names"""
+    if statistic_name == "all":
+        return list(STATISTIC_REGISTRY.keys())
+    return statistic_name.split(",")
+
+
+def get_statistic_args(data_type, statistic_names, target_error=None):
+    """Parameters of each statistic, with the target relative error of the approximable ones"""
+    statistic_args_datatype = STATISTIC_PARAMS[data_type]
+    statistic_args = {name:statistic_args_datatype.get(name, dict()) for name in statistic_names}
+    if target_error is not None:
+        for name in statistic_names:
+            if STATISTIC_REGISTRY[name].__name__ in APPROXIMATIONS:
+                statistic_args[name] = {**statistic_args[name], "target_error":target_error}
+    return statistic_args
+
+
+def get_statistic_function(statistic_name, params):
+    """The registered statistic, or its approximation if it is given a target relative error"""
+    function = STATISTIC_REGISTRY[statistic_name]
+    if "target_error" in params:
+        return APPROXIMATIONS[function.__name__]
+    return function
+
+
+def get_output_names(statistic_names, statistic_args):
+    """Map the name of every saved statistic to its registered name
+
+    Sweeps save one statistic per value and approximations also save the standard
+    error of each, as "{name}_se".
+    """
+    output_names = dict()
+    for statistic_name in statistic_names:
+        params = statistic_args[statistic_name]
+        for output_name in sweep_names(statistic_name, params):
+            output_names[output_name] = statistic_name
+            if "target_error" in params:
+                output_names[f"{output_name}_se"] = statistic_name
+    return output_names
+
+
+def single_threaded(function, params):
+    """Parameters that run the function's KD-tree queries on one thread, unless workers is set"""
+    if "workers" in params or "workers" not in inspect.signature(function).parameters:
+        return params
+    return {**params, "workers":1}
+
+
+def sample_statistics(processed_path, file_name, statistic_names, statistic_args, profile=None,
+                      single_thread=False):
+    """Load one sample and calculate every given statistic on it
+
+    If profile is the path of a profile log, the resources used by each statistic are appended to it.
+    If single_thread, statistics that default to querying on every core use one thread instead,
+    so that worker processes do not compete for the cores.
+    """
+    try:
+        spatial_sample = read_sample(processed_path, file_name)
+    except Exception as e:
+        print(f"Error: {file_name}")
+        print(e)
+        return dict()
+    source = file_name.split(" ")[0]
+    sample = file_name.split(" ")[1][:-4]
+    cell_counts = spatial_sample.counts
+    rows = dict()
+    records = []
+    for statistic_name in statistic_names:
+        params = statistic_args[statistic_name]
+        statistic_calculation = get_statistic_function(statistic_name, params)
+        call_params = single_threaded(statistic_calculation, params) if single_thread else params
         try:
-            statistic = statistic_calculation(df_sample, **statistic_args)
+            with profiled(records, statistic_name, statistic_calculation, file_name[:-4],
+                          cell_counts, params):
+                if sweep_parameter(params) is None:
+                    statistics = [statistic_calculation(spatial_sample, **call_params)]
+                else:
+                    statistics = calculate_sweep(statistic_calculation, spatial_sample, call_params)
         except Exception as e:
-            print(f"Error: {file_name}")
+            print(f"Error: {statistic_name} {file_name}")
             print(e)
             continue
-        source = file_name.split(" ")[0]
-        sample = file_name.split(" ")[1][:-4]
-        rows.append({"source": source, "sample": sample, statistic_name: statistic})
+        for output_name, statistic in zip(sweep_names(statistic_name, params), statistics):
+            if "target_error" in params:
+                statistic, standard_error = statistic
+                rows[f"{output_name}_se"] = {"source": source, "sample": sample,
+                                             f"{output_name}_se": standard_error}
+            rows[output_name] = {"source": source, "sample": sample, output_name: statistic}
+    write_profile(profile, records)
     return rows
 
 
-def main(data_type, statistic_name, source=None, sample=None):
-    processed_path = get_data_path(data_type, "processed")
+def sample_task_statistics(processed_path, task, statistic_args, profile=None, single_thread=False):
+    file_name, statistic_names = task
+    return sample_statistics(processed_path, file_name, statistic_names, statistic_args, profile,
+                             single_thread)
 
-    statistic_calculation = STATISTIC_REGISTRY[statistic_name]
-    statistic_args_datatype = STATISTIC_PARAMS[data_type]
-    statistic_args = dict()
-    if statistic_name in statistic_args_datatype:
-        statistic_args = statistic_args_datatype[statistic_name]
 
-    if source is None and sample is None:
-        statistics_path = get_data_path(data_type, "statistics")
-        save_loc = f"{statistics_path}/{statistic_name}.pkl"
+def calculate_statistics(processed_path, file_names, statistic_names, statistic_args,
+                         workers=1, chunk_size=None, profile=None):
+    file_names = [x for x in file_names if x != "payoff.csv"]
+    if chunk_size is None:
+        chunk_size = max(1, min(16, len(file_names)//(4*workers)))
+    calculation = partial(sample_statistics, processed_path,
+                          statistic_names=statistic_names, statistic_args=statistic_args,
+                          profile=profile, single_thread=workers > 1)
+    rows = {output_name:[] for output_name in get_output_names(statistic_names, statistic_args)}
+    for sample_rows in parallel_map(calculation, file_names, workers, chunk_size):
+        for statistic_name, row in sample_rows.items():
+            rows[statistic_name].append(row)
+    return rows
+
+
+def calculate_stale_statistics(data_type, processed_path, file_names, statistic_names,
+                               statistic_args, workers=1, stage="statistics", profile=None):
+    """Calculate only the statistics whose manifest entry is missing or out of date
+
+    Each result is saved as a per-sample shard in {stage}/{statistic_name}
+    and recorded in the manifest as soon as it is written.
+    """
+    statistics_path = get_data_path(data_type, stage)
+    manifest = Manifest(f"{statistics_path}/manifest.jsonl")
+    output_names = get_output_names(statistic_names, statistic_args)
+    parameter_hashes = {name:parameter_hash(STATISTIC_REGISTRY[name], statistic_args[name])
+                        for name in statistic_names}
+    tasks = []
+    input_hashes = dict()
+    for file_name in file_names:
+        if file_name == "payoff.csv":
+            continue
+        sample_key = file_name[:-4]
+        input_hash = manifest.input_hash(sample_key, f"{processed_path}/{file_name}")
+        stale = {statistic_name for output_name, statistic_name in output_names.items()
+                 if not manifest.is_current(output_name, parameter_hashes[statistic_name],
+                                            sample_key, input_hash)}
+        stale = [name for name in statistic_names if name in stale]
+        if len(stale) > 0:
+            tasks.append((file_name, stale))
+            input_hashes[sample_key] = input_hash
+    print(f"Calculating statistics for {len(tasks)} samples with missing or stale results.")
+
+    calculation = partial(sample_task_statistics, processed_path, statistic_args=statistic_args,
+                          profile=profile, single_thread=workers > 1)
+    chunk_size = max(1, min(16, len(tasks)//(4*workers)))
+    results = parallel_map(calculation, tasks, workers, chunk_size)
+    for (file_name, _), sample_rows in zip(tasks, results):
+        sample_key = file_name[:-4]
+        for output_name, row in sample_rows.items():
+            statistic_name = output_names[output_name]
+            shard_path = get_data_path(data_type, f"{stage}/{output_name}")
+            save_loc = f"{shard_path}/{sample_key}.pkl"
+            statistic_df([row], output_name, STATISTIC_REGISTRY[statistic_name]).to_pickle(save_loc)
+            manifest.record(output_name, parameter_hashes[statistic_name], sample_key,
+                            input_hashes[sample_key], save_loc)
+
+
+def main(data_type, statistic_name, source=None, sample=None, workers=1, domain_cache=False,
+         incremental=False, target_error=None, samples=None, profile=False):
+    processed_path = get_data_path(data_type, "processed")
+    if domain_cache:
+        DOMAIN_CACHE.path = get_data_path(data_type, "domain_cache")
+    stage = "statistics" if target_error is None else "statistics_approx"
+    statistic_names = get_statistic_names(statistic_name)
+    statistic_args = get_statistic_args(data_type, statistic_names, target_error)
+    output_names = get_output_names(statistic_names, statistic_args)
+    profile = profile_path(data_type, stage) if profile else None
+
+    aggregate = source is None and sample is None and samples is None
+    if aggregate:
         file_names = os.listdir(processed_path)
+    elif samples is not None:
+        file_names = select_samples(processed_path, samples)
     else:
         print(source, sample)
-        statistics_path = get_data_path(data_type, f"statistics/{statistic_name}")
-        save_loc = f"{statistics_path}/{source} {sample}.pkl"
         file_names = [f"{source} {sample}.csv"]
 
-    rows = calculate_statistics(
-        processed_path, file_names, statistic_name, statistic_calculation, statistic_args
-    )
-    df = pd.DataFrame(rows)
-    if is_object_dtype(df[statistic_name]):
-        if statistic_calculation.__name__.endswith("dist"):
-            df["type"] = "distribution"
-        else:
-            df["type"] = "function"
-    else:
-        df["type"] = "value"
-    df.to_pickle(save_loc)
+    if incremental:
+        calculate_stale_statistics(data_type, processed_path, file_names, statistic_names,
+                                   statistic_args, workers, stage, profile)
+        if aggregate:
+            for output_name in output_names:
+                combine_sample_statistics.main(data_type, output_name, stage=stage)
+        return
+
+    rows = calculate_statistics(processed_path, file_names, statistic_names, statistic_args, workers,
+                                profile=profile)
+    for output_name, statistic_name in output_names.items():
+        statistic_function = STATISTIC_REGISTRY[statistic_name]
+        if aggregate:
+            if len(rows[output_name]) == 0:
+                print(f"No samples calculated {output_name}.")
+                continue
+            df = statistic_df(rows[output_name], output_name, statistic_function)
+            save_statistic(df, get_data_path(data_type, stage), output_name)
+            continue
+        statistics_path = get_data_path(data_type, f"{stage}/{output_name}")
+        for row in rows[output_name]:
+            df = statistic_df([row], output_name, statistic_function)
+            df.to_pickle(f"{statistics_path}/{row['source']} {row['sample']}.pkl")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 5:
-        main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
-    elif len(sys.argv) == 3:
-        main(sys.argv[1], sys.argv[2])
-    else:
-        print("Please provide the data type and statistic name")
-        print("and a source and sample id, if calculating individual samples.")
+    parser = argparse.ArgumentParser(
+        description="Calculate spatial statistics on processed samples.")
+    parser.add_argument("data_type", help="the parent data dir")
+    parser.add_argument("statistic_name",
+                        help="statistic name, \"all\", or a comma-separated list of names")
+    parser.add_argument("source", nargs="?", help="source, if calculating an individual sample")
+    parser.add_argument("sample", nargs="?", help="sample id, if calculating an individual sample")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (if more than one, each queries on one thread)")
+    parser.add_argument("--domain-cache", action="store_true",
+                        help="save muspan domains to data/{data_type}/domain_cache and reuse them")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only calculate results that are missing or stale in the manifest")
+    parser.add_argument("--approximate", type=float, metavar="TARGET_ERROR",
+                        help="estimate the statistics that have an approximation from a subset of "
+                             "cells, to this relative standard error, and save them with their "
+                             "standard errors in data/{data_type}/statistics_approx")
+    parser.add_argument("--samples", metavar="FILE",
+                        help="calculate the samples listed in FILE (one \"{source} {sample_id}\" "
+                             "per line), saving per-sample results like an individual sample")
+    parser.add_argument("--profile", action="store_true",
+                        help="append the time and memory used by each statistic to "
+                             "data/{data_type}/statistics/profile.jsonl (see profiling)")
+    args = parser.parse_args()
+    if (args.source is None) != (args.sample is None):
+        parser.error("Please provide both a source and sample id, if calculating individual samples.")
+    if args.source is not None and args.samples is not None:
+        parser.error("Please provide either an individual sample or a sample list, not both.")
+    main(args.data_type, args.statistic_name, args.source, args.sample, args.workers,
+         args.domain_cache, args.incremental, args.approximate, args.samples, args.profile)
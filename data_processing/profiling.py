@@ -0,0 +1,162 @@
+"""Profile statistic calculations and summarise the costs.
+
+Expected usage:
+python3 -m spatial_egt.data_processing.profiling data_type (--approximate) (--threshold T)
+
+Where:
+data_type: the parent data dir
+--approximate: optional, summarise the profile of approximate statistics in statistics_approx
+--threshold: optional, the robust z-score above which a sample's cost is an outlier (default 3.5)
+
+Runs of processed_to_statistics and domain_to_statistics given --profile append one
+record per statistic and sample to data/{data_type}/statistics/profile.jsonl, with the
+wall time, CPU time (of the calculating process and its threads), peak resident memory
+of the process, cell counts per type and parameters of the calculation.
+
+The summary ranks statistics by their median wall time per cell, with the exponent of
+a power law fit of wall time against number of cells (which can be used to update
+COST_EXPONENTS in write_statistics_bash), and lists the samples whose cost per cell
+is an outlier, by the median absolute deviation of the log cost per cell.
+"""
+
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from spatial_egt.common import get_data_path
+
+
+def profile_path(data_type, stage="statistics"):
+    return f"{get_data_path(data_type, stage)}/profile.jsonl"
+
+
+def peak_rss():
+    """Peak resident set size of this process so far, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak*1024
+
+
+@contextmanager
+def profiled(records, statistic, function, sample, cell_counts, params):
+    """Append a record of the resources used by the calculation in the with block to records
+
+    Peak memory is the high-water mark of the process, so rss_growth (how far the
+    calculation raised it) is the better measure of a statistic's own memory use.
+    """
+    record = {"statistic":statistic, "function":f"{function.__module__}.{function.__qualname__}",
+              "sample":sample, "cells":cell_counts,
+              "parameters":json.dumps(params, sort_keys=True, default=str)}
+    rss_before = peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        record["wall"] = time.perf_counter() - wall_start
+        record["cpu"] = time.process_time() - cpu_start
+        record["peak_rss"] = peak_rss()
+        record["rss_growth"] = record["peak_rss"] - rss_before
+        record["failed"] = failed
+        records.append(record)
+
+
+def write_profile(path, records):
+    """Append records to the profile log in a single write, so worker processes do not interleave"""
+    if path is None or len(records) == 0:
+        return
+    lines = "".join(json.dumps(record)+"\n" for record in records)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, lines.encode())
+    finally:
+        os.close(fd)
+
+
+def read_profile(path):
+    """Profile records as a dataframe, keeping the latest record of each calculation"""
+    records = []
+    with open(path, encoding="UTF-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    df = pd.DataFrame(records)
+    df = df.drop_duplicates(subset=["statistic", "parameters", "sample"], keep="last")
+    df["num_cells"] = [sum(x.values()) for x in df["cells"]]
+    return df[~df["failed"]].reset_index(drop=True)
+
+
+def fit_exponent(num_cells, wall):
+    """Exponent of the least squares power law fit of wall time against number of cells"""
+    keep = (num_cells > 0) & (wall > 0)
+    if len(np.unique(num_cells[keep])) < 3:
+        return np.nan
+    return np.polyfit(np.log(num_cells[keep]), np.log(wall[keep]), 1)[0]
+
+
+def robust_z(values):
+    """Deviation of each value from the median, in units of the scaled median absolute deviation"""
+    deviation = values - np.median(values)
+    mad = np.median(np.abs(deviation))
+    if mad == 0:
+        return np.zeros(len(values))
+    return 0.6745*deviation/mad
+
+
+def summarise(df, threshold=3.5):
+    """Summary of each statistic's cost, costliest per cell first, and the outlying samples"""
+    df = df[df["num_cells"] > 0].copy()
+    df["us_per_cell"] = 1e6*df["wall"]/df["num_cells"]
+    summary = []
+    outliers = []
+    for statistic, statistic_df in df.groupby("statistic"):
+        num_cells = statistic_df["num_cells"].to_numpy(dtype=float)
+        wall = statistic_df["wall"].to_numpy()
+        summary.append({"statistic":statistic, "samples":len(statistic_df),
+                        "us_per_cell":statistic_df["us_per_cell"].median(),
+                        "exponent":fit_exponent(num_cells, wall),
+                        "wall":wall.sum(), "cpu":statistic_df["cpu"].sum(),
+                        "max_rss_growth_mb":statistic_df["rss_growth"].max()/2**20})
+        z = robust_z(np.log(statistic_df["us_per_cell"].to_numpy()))
+        outlying = statistic_df[z > threshold].assign(z=z[z > threshold])
+        outliers.append(outlying[["statistic", "sample", "num_cells", "wall", "us_per_cell", "z"]])
+    summary = pd.DataFrame(summary).sort_values("us_per_cell", ascending=False)
+    summary["wall_share"] = summary["wall"]/summary["wall"].sum()
+    outliers = pd.concat(outliers, ignore_index=True) if len(outliers) > 0 else pd.DataFrame()
+    return summary.reset_index(drop=True), outliers
+
+
+def main(data_type, stage="statistics", threshold=3.5):
+    path = profile_path(data_type, stage)
+    if not os.path.exists(path):
+        print(f"No profile at {path}, run the statistics with --profile.")
+        return
+    summary, outliers = summarise(read_profile(path), threshold)
+    with pd.option_context("display.max_rows", None, "display.width", 200, "display.precision", 3):
+        print(summary.to_string(index=False))
+        if len(outliers) == 0:
+            print("\nNo samples with outlying cost per cell.")
+        else:
+            print(f"\nSamples with outlying cost per cell (robust z > {threshold}):")
+            print(outliers.sort_values("z", ascending=False).to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise the profile of statistic calculations.")
+    parser.add_argument("data_type", help="the parent data dir")
+    parser.add_argument("--approximate", action="store_true",
+                        help="summarise the profile of approximate statistics in statistics_approx")
+    parser.add_argument("--threshold", type=float, default=3.5,
+                        help="robust z-score of the log cost per cell above which a sample is an outlier")
+    args = parser.parse_args()
+    main(args.data_type, "statistics_approx" if args.approximate else "statistics", args.threshold)
@@ -0,0 +1,114 @@
+"""Ragged per-sample arrays stored as flat values with offsets, and reductions over them"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def flatten(arrays):
+    """Concatenate 1D arrays into flat values and offsets
+
+    Array i is values[offsets[i]:offsets[i+1]].
+    """
+    arrays = [np.asarray(x, dtype=np.float64).ravel() for x in arrays]
+    offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+    np.cumsum([len(x) for x in arrays], out=offsets[1:])
+    if len(arrays) == 0:
+        return np.empty(0, dtype=np.float64), offsets
+    return np.concatenate(arrays), offsets
+
+
+def segment_reduce(ufunc, values, offsets):
+    """Reduce each segment with a numpy ufunc (add, minimum, ...), giving NaN for empty segments"""
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    result = np.full(len(lengths), np.nan)
+    if np.any(nonempty):
+        result[nonempty] = ufunc.reduceat(values, offsets[:-1][nonempty])
+    return result
+
+
+def segment_mean(values, offsets):
+    with np.errstate(invalid="ignore"):
+        return segment_reduce(np.add, values, offsets)/np.diff(offsets)
+
+
+def segment_moments(values, offsets):
+    """Mean, SD, skew and excess kurtosis of each segment
+
+    Uses the same arithmetic as np.mean, np.std and scipy's biased skew and
+    kurtosis, so results match applying those to each segment separately up to
+    summation order, including NaN skew and kurtosis for near-constant segments.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    lengths = np.diff(offsets)
+    segment_ids = np.repeat(np.arange(len(lengths)), lengths)
+    mean = segment_mean(values, offsets)
+    deviation = values - mean[segment_ids]
+    squared = deviation**2
+    m2 = segment_mean(squared, offsets)
+    m3 = segment_mean(squared*deviation, offsets)
+    m4 = segment_mean(squared**2, offsets)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sd = np.sqrt(m2)
+        zero = m2 <= (np.finfo(np.float64).resolution*mean)**2
+        skew = np.where(zero, np.nan, m3/m2**1.5)
+        kurtosis = np.where(zero, np.nan, m4/m2**2.0) - 3
+    return mean, sd, skew, kurtosis
+
+
+class RaggedStatistic:
+    """Memory-mapped distribution or function statistic saved with save_ragged
+
+    The directory holds the flat float32 values, the int64 offsets, the (source, sample)
+    key of each row and the statistic metadata. Values are only read from disk when
+    they are accessed, so looking up one sample does not load the whole statistic.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(f"{path}/metadata.json", encoding="UTF-8") as f:
+            metadata = json.load(f)
+        self.name = metadata["name"]
+        self.type = metadata["type"]
+        self.values = np.load(f"{path}/values.npy", mmap_mode="r")
+        self.offsets = np.load(f"{path}/offsets.npy", mmap_mode="r")
+        self.keys = pd.read_csv(f"{path}/keys.csv", dtype=str)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, source, sample):
+        """Values of one sample, as a view of the memory-mapped values"""
+        matches = np.flatnonzero((self.keys["source"] == source) & (self.keys["sample"] == str(sample)))
+        if len(matches) == 0:
+            raise KeyError((source, sample))
+        i = matches[0]
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def to_long_df(self):
+        """One row per value, with the source and sample the value belongs to"""
+        lengths = np.diff(self.offsets)
+        df = self.keys.loc[np.repeat(np.arange(len(self.keys)), lengths)].reset_index(drop=True)
+        df[self.name] = np.asarray(self.values)
+        return df
+
+    def to_df(self):
+        """One row per sample with the values as an array, as in the pickled statistics"""
+        df = self.keys.copy()
+        df[self.name] = [self.values[self.offsets[i]:self.offsets[i+1]] for i in range(len(df))]
+        df["type"] = self.type
+        return df
+
+
+def save_ragged(path, df, name, statistic_type):
+    """Save a dataframe with source, sample and array-valued name columns as a ragged statistic"""
+    os.makedirs(path, exist_ok=True)
+    values, offsets = flatten(df[name])
+    np.save(f"{path}/values.npy", values.astype(np.float32))
+    np.save(f"{path}/offsets.npy", offsets)
+    df[["source", "sample"]].astype(str).to_csv(f"{path}/keys.csv", index=False)
+    with open(f"{path}/metadata.json", "w", encoding="UTF-8") as f:
+        json.dump({"name":name, "type":statistic_type}, f)
@@ -0,0 +1,111 @@
+"""Approximate nc_dist, nn_dist and cross_k from a random subset of query cells
+
+Each statistic is a mean over query cells of a per-cell quantity (the neighbourhood
+fraction, the nearest neighbour distance, or the number of neighbours within each
+radius), so it is estimated from a random subset of the query cells, searched against
+every reference cell. The standard error of the mean is found by bootstrapping the
+subset. Given a target relative error, the subset grows until the standard error is
+within it or every cell is used. The subset is the start of one random permutation
+of the cells, so growing it only searches the new cells.
+
+Each function returns the statistic (the subset's values for distributions) and the
+standard error (of the mean for distributions, at each radius for cross_k).
+"""
+
+import numpy as np
+
+from spatial_egt.data_processing.spatial_statistics.pair_counts import (cross_k_radii, edge_weights, planar,
+                                                                       window, window_volume)
+from spatial_egt.data_processing.spatial_statistics.sample import as_sample
+from spatial_egt.data_processing.spatial_statistics.sweeps import radius_neighbor_counts
+
+
+def bootstrap_mean(values, num_bootstrap, rng):
+    """Mean of the rows of values, ignoring NaN, and its bootstrap standard error"""
+    values = values.reshape(len(values), -1)
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0)
+    weights = rng.multinomial(len(values), np.full(len(values), 1/len(values)), size=num_bootstrap)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=0)/valid.sum(axis=0)
+        means = (weights @ filled)/(weights @ valid)
+    return mean, np.nanstd(means, axis=0)
+
+
+def subsample(per_query, num_cells, num_queries=1000, target_error=None, num_bootstrap=200, seed=None):
+    """Per-query values of a random subset of the cells, with their mean and its standard error
+
+    per_query maps cell indices to an array of values with one row per cell.
+    """
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(num_cells)
+    size = min(num_queries, num_cells)
+    values = per_query(np.sort(order[:size]))
+    while True:
+        mean, standard_error = bootstrap_mean(values, num_bootstrap, rng)
+        if target_error is None or size == num_cells:
+            break
+        with np.errstate(invalid="ignore", divide="ignore"):
+            relative_error = np.nanmax(standard_error/np.abs(mean), initial=0)
+        if relative_error <= target_error:
+            break
+        # the standard error shrinks with the square root of the subset size
+        new_size = int(np.ceil(1.2*size*(relative_error/target_error)**2))
+        new_size = min(num_cells, max(new_size, size+1))
+        values = np.concatenate((values, per_query(np.sort(order[size:new_size]))))
+        size = new_size
+    return values, mean, standard_error
+
+
+def nc_dist(sample, radius, return_fs=True, num_queries=1000, target_error=None, seed=None, workers=-1):
+    sample = as_sample(sample)
+    query_type, other_type = ("resistant", "sensitive") if return_fs else ("sensitive", "resistant")
+    query_coords = sample.coords_of(query_type)
+    def per_query(cells):
+        coords = query_coords[cells]
+        same = sample.tree(query_type).query_ball_point(coords, radius, return_length=True, workers=workers)
+        other = sample.tree(other_type).query_ball_point(coords, radius, return_length=True, workers=workers)
+        neighbors = same + other - 1
+        fractions = np.full(len(cells), np.nan)
+        keep = (neighbors != 0) & (other != 0)
+        fractions[keep] = other[keep]/neighbors[keep]
+        return fractions
+    values, _, standard_error = subsample(per_query, len(query_coords), num_queries, target_error, seed=seed)
+    return values[~np.isnan(values)].tolist(), float(standard_error[0])
+
+
+def nn_dist(sample, cell_type1="sensitive", cell_type2="resistant", num_queries=1000,
+            target_error=None, seed=None, workers=-1):
+    sample = planar(sample)
+    if sample.count(cell_type2) < (2 if cell_type1 == cell_type2 else 1):
+        raise ValueError(f"Sample has too few {cell_type2} cells.")
+    query_coords = sample.coords_of(cell_type1)
+    k = 2 if cell_type1 == cell_type2 else 1
+    def per_query(cells):
+        distances, _ = sample.tree(cell_type2).query(query_coords[cells], k=[k], workers=workers)
+        return distances[:, 0]
+    values, _, standard_error = subsample(per_query, len(query_coords), num_queries, target_error, seed=seed)
+    return values, float(standard_error[0])
+
+
+def cross_k(sample, max_radius, step, cell_type1="sensitive", cell_type2="resistant", edge_correction=True,
+            num_queries=1000, target_error=None, seed=None, workers=-1):
+    sample = planar(sample)
+    if sample.count(cell_type1) == 0 or sample.count(cell_type2) == 0:
+        raise ValueError(f"Sample has no {cell_type1} or no {cell_type2} cells.")
+    radii = cross_k_radii(max_radius, step)
+    query_coords = sample.coords_of(cell_type1)
+    lower, upper = window(sample)
+    def per_query(cells):
+        counts = radius_neighbor_counts(sample.tree(cell_type2), query_coords[cells], radii, workers)
+        if not edge_correction:
+            return counts
+        points = query_coords[cells].astype(float)
+        return counts*np.stack([edge_weights(points, -1, r, lower, upper) for r in radii], axis=1)
+    _, mean, standard_error = subsample(per_query, len(query_coords), num_queries, target_error, seed=seed)
+    # K(r) is the mean number of cell_type2 neighbours of a cell_type1 cell over their intensity
+    scale = window_volume(sample)/sample.count(cell_type2)
+    return mean*scale, standard_error*scale
+
+
+APPROXIMATIONS = {"nc_dist":nc_dist, "nn_dist":nn_dist, "cross_k":cross_k}
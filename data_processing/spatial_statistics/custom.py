@@ -1,32 +1,28 @@
 from random import choices
 
 import numpy as np
-from scipy.spatial import KDTree
+
+from spatial_egt.data_processing.spatial_statistics.raster import window_counts
+from spatial_egt.data_processing.spatial_statistics.sample import as_sample
 
 
 # Spatial Subsample
-def sfp_dist(df, sample_length, num_samples=1000, return_fs=True):
-    dimensions = list(df.drop("type", axis=1).columns)
-    s_coords = df[df["type"] == "sensitive"][dimensions].values
-    r_coords = df[df["type"] == "resistant"][dimensions].values
-    dims = range(len(dimensions))
+def sfp_dist(sample, sample_length, num_samples=1000, return_fs=True):
+    sample = as_sample(sample)
+    s_coords = sample.coords_of("sensitive")
+    r_coords = sample.coords_of("resistant")
+    dims = range(len(sample.dimensions))
 
     max_dims = [max(np.max(s_coords[:, i]), np.max(r_coords[:, i])) for i in dims]
     dim_vals = [choices(range(0, max_dims[i]-sample_length), k=num_samples) for i in dims]
-    fs_counts = []
-    fr_counts = []
-    for s in range(num_samples):
-        ld = [dim_vals[i][s] for i in dims]
-        ud = [ld[i]+sample_length for i in dims]
-        subset_s = [(s_coords[:, i] >= ld[i]) & (s_coords[:, i] <= ud[i]) for i in dims]
-        subset_s = np.sum(np.all(subset_s, axis=0))
-        subset_r = [(r_coords[:, i] >= ld[i]) & (r_coords[:, i] <= ud[i]) for i in dims]
-        subset_r = np.sum(np.all(subset_r, axis=0))
-        subset_total = subset_s + subset_r
-        if subset_total == 0:
-            continue
-        fs_counts.append(subset_s/subset_total)
-        fr_counts.append(subset_r/subset_total)
+    ld = np.array(dim_vals, dtype=np.int64).T
+
+    subset_s = window_counts(sample, "sensitive", ld, sample_length)
+    subset_r = window_counts(sample, "resistant", ld, sample_length)
+    subset_total = subset_s + subset_r
+    nonempty = subset_total != 0
+    fs_counts = (subset_s[nonempty]/subset_total[nonempty]).tolist()
+    fr_counts = (subset_r[nonempty]/subset_total[nonempty]).tolist()
 
     if return_fs:
         return fs_counts
@@ -34,34 +30,39 @@ def sfp_dist(df, sample_length, num_samples=1000, return_fs=True):
 
 
 # Neighborhood Composition
-def nc_dist(df, radius, return_fs=True):
-    dimensions = list(df.drop("type", axis=1).columns)
-    s_coords = df[df["type"] == "sensitive"][dimensions].values
-    r_coords = df[df["type"] == "resistant"][dimensions].values
-    all_coords = np.concatenate((s_coords, r_coords), axis=0)
+def nc_fractions(s_neighbors, r_neighbors, s_stop, return_fs=True):
+    """Neighbourhood fractions from per-cell neighbour counts (including the cell itself), sensitive cells first."""
+    all_neighbors = s_neighbors + r_neighbors - 1
 
-    s_stop = len(s_coords)
-    tree = KDTree(all_coords)
-    fs = []
-    fr = []
-    for p,point in enumerate(all_coords):
-        neighbor_indices = tree.query_ball_point(point, radius)
-        all_neighbors = len(neighbor_indices)-1
-        if p <= s_stop: #sensitive cell
-            r_neighbors = len([x for x in neighbor_indices if x > s_stop])
-            if all_neighbors != 0 and r_neighbors != 0:
-                fr.append(r_neighbors/all_neighbors)
-        else: #resistant cell
-            s_neighbors = len([x for x in neighbor_indices if x <= s_stop])
-            if all_neighbors != 0 and s_neighbors != 0:
-                fs.append(s_neighbors/all_neighbors)
+    #sensitive cells
+    s_all, s_r = all_neighbors[:s_stop], r_neighbors[:s_stop]
+    keep = (s_all != 0) & (s_r != 0)
+    fr = (s_r[keep]/s_all[keep]).tolist()
+    #resistant cells
+    r_all, r_s = all_neighbors[s_stop:], s_neighbors[s_stop:]
+    keep = (r_all != 0) & (r_s != 0)
+    fs = (r_s[keep]/r_all[keep]).tolist()
 
     if return_fs:
         return fs
     return fr
 
 
-def proportion_s(df):
-    num_sensitive = len(df[df["type"] == "sensitive"])
-    num_resistant = len(df[df["type"] == "resistant"])
+def nc_dist(sample, radius, return_fs=True, workers=-1):
+    sample = as_sample(sample)
+    s_coords = sample.coords_of("sensitive")
+    r_coords = sample.coords_of("resistant")
+    all_coords = np.concatenate((s_coords, r_coords), axis=0)
+
+    s_neighbors = sample.tree("sensitive").query_ball_point(all_coords, radius,
+                                                            return_length=True, workers=workers)
+    r_neighbors = sample.tree("resistant").query_ball_point(all_coords, radius,
+                                                            return_length=True, workers=workers)
+    return nc_fractions(s_neighbors, r_neighbors, len(s_coords), return_fs)
+
+
+def proportion_s(sample):
+    sample = as_sample(sample)
+    num_sensitive = sample.count("sensitive")
+    num_resistant = sample.count("resistant")
     return num_sensitive/(num_resistant+num_sensitive)
@@ -0,0 +1,57 @@
+"""Cache of muspan domains and domain-derived artifacts keyed by sample content"""
+
+from collections import OrderedDict
+import os
+
+import muspan as ms
+
+
+class DomainCache:
+    """Least recently used in-memory cache of domains, backed by an optional directory
+
+    Keys are tuples starting with the content hash of the sample, followed by the
+    name and parameters of any artifact (hexgrid, alpha shapes, ...) added to the domain.
+    If path is set, built domains are also saved there with ms.io.save_domain and
+    loaded back by later runs instead of being rebuilt.
+    """
+
+    def __init__(self, max_size=8, path=None):
+        self.max_size = max_size
+        self.path = path
+        self._domains = OrderedDict()
+
+    def file_name(self, key):
+        return " ".join(str(x) for x in key).replace("/", "-")
+
+    def load(self, key):
+        if self.path is None:
+            return None
+        file_path = f"{self.path}/{self.file_name(key)}.muspan"
+        if not os.path.exists(file_path):
+            return None
+        return ms.io.load_domain(file_path, print_metadata=False, print_summary=False)
+
+    def save(self, key, domain):
+        if self.path is None:
+            return
+        ms.io.save_domain(domain, path_to_save=self.path, name_of_file=self.file_name(key))
+
+    def get(self, key, build):
+        """Return the domain for key, loading it from disk or calling build() if it is not cached"""
+        if key in self._domains:
+            self._domains.move_to_end(key)
+            return self._domains[key]
+        domain = self.load(key)
+        if domain is None:
+            domain = build()
+            self.save(key, domain)
+        self._domains[key] = domain
+        while len(self._domains) > self.max_size:
+            self._domains.popitem(last=False)
+        return domain
+
+    def clear(self):
+        self._domains.clear()
+
+
+DOMAIN_CACHE = DomainCache()
@@ -1,15 +1,17 @@
+from weakref import WeakKeyDictionary
+
 import muspan as ms
 import numpy as np
 
-from spatial_egt.data_processing.spatial_statistics.muspan_statistics import create_muspan_domain
+from spatial_egt.data_processing.spatial_statistics.muspan_statistics import derived_domain
+from spatial_egt.data_processing.spatial_statistics.sample import as_sample
 
 
-def create_patches(df, alpha):
-    domain = create_muspan_domain(df)
-    if len(df[df["type"] == "sensitive"]) > len(df[df["type"] == "resistant"]):
-        cell_type = "resistant"
-    else:
-        cell_type = "sensitive"
+# patch measures of each loaded domain, shared by the patch statistics and dropped with the domain
+PATCH_MEASURES = WeakKeyDictionary()
+
+
+def add_alpha_shapes(domain, cell_type, alpha):
     domain.convert_objects(
         population=("type", cell_type),
         collection_name="shape",
@@ -17,30 +19,41 @@ def create_patches(df, alpha):
         conversion_method="alpha shape",
         conversion_method_kwargs=dict(alpha=alpha)
     )
-    return domain
+
+
+def create_patches(sample, alpha):
+    sample = as_sample(sample)
+    if sample.count("sensitive") > sample.count("resistant"):
+        cell_type = "resistant"
+    else:
+        cell_type = "sensitive"
+    return derived_domain(sample, "alpha shape", add_alpha_shapes, cell_type=cell_type, alpha=alpha)
+
+
+def patch_measure(domain, measure):
+    """Area, perimeter or circularity of every patch, calculated once per domain"""
+    measures = PATCH_MEASURES.setdefault(domain, dict())
+    if measure not in measures:
+        patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
+        values, _ = getattr(ms.geometry, measure)(domain, population=patch_pop)
+        measures[measure] = np.array(values)
+    return measures[measure]
 
 
 def patch_count(domain):
-    patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
-    area, _ = ms.geometry.area(domain, population=patch_pop)
-    return len(area)
+    return len(patch_measure(domain, "area"))
 
 
 def area_dist(domain):
-    patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
-    area, _ = ms.geometry.area(domain, population=patch_pop)
-    return area
+    return patch_measure(domain, "area")
 
 
 def circularity_dist(domain):
-    patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
-    circ, _ = ms.geometry.circularity(domain, population=patch_pop)
-    return circ
+    return patch_measure(domain, "circularity")
 
 
 def fractal_dimension_dist(domain):
-    patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
-    area, _ = ms.geometry.area(domain, population=patch_pop)
-    perim, _ = ms.geometry.perimeter(domain, population=patch_pop)
-    frac_dim = 2*np.log(np.array(perim))/np.log(np.array(area))
+    area = patch_measure(domain, "area")
+    perim = patch_measure(domain, "perimeter")
+    frac_dim = 2*np.log(perim)/np.log(area)
     return frac_dim
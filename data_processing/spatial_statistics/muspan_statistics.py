@@ -1,27 +1,49 @@
 import muspan as ms
-import numpy as np
 
+from spatial_egt.data_processing.spatial_statistics.domain_cache import DOMAIN_CACHE
+from spatial_egt.data_processing.spatial_statistics.sample import as_sample
 
-def create_muspan_domain(df):
+
+def create_muspan_domain(sample):
+    sample = as_sample(sample)
     domain = ms.domain("sample")
-    points = np.asarray([df["x"], df["y"]])
-    domain.add_points(points.T, "cells")
-    domain.add_labels("type", df["type"])
+    domain.add_points(sample.coords[:, :2], "cells")
+    domain.add_labels("type", sample.labels())
     return domain
 
 
-def local_moransi_dist(df, cell_type, side_length):
-    domain = create_muspan_domain(df)
+def muspan_domain(sample):
+    """Domain of the sample, built once and shared by every statistic that does not modify it"""
+    sample = as_sample(sample)
+    return DOMAIN_CACHE.get((sample.content_hash(),), lambda: create_muspan_domain(sample))
+
+
+def derived_domain(sample, artifact, build, **params):
+    """Domain of the sample with an artifact added by build(domain, **params), memoized per parameter set"""
+    sample = as_sample(sample)
+    key = (sample.content_hash(), artifact) + tuple(f"{k}={v}" for k, v in sorted(params.items()))
+    def build_domain():
+        domain = create_muspan_domain(sample)
+        build(domain, **params)
+        return domain
+    return DOMAIN_CACHE.get(key, build_domain)
+
+
+def add_hexgrid(domain, side_length):
     ms.region_based.generate_hexgrid(domain, side_length=side_length,
                                      regions_collection_name="grids",
                                      remove_empty_regions=False)
+
+
+def local_moransi_dist(sample, cell_type, side_length):
+    domain = derived_domain(sample, "hexgrid", add_hexgrid, side_length=side_length)
     _, _, lmi, _, _ = ms.spatial_statistics.morans_i(domain, population=("Collection", "grids"),
                                                      label_name=f"region counts: {cell_type}")
     return lmi
 
 
-def nn_dist(df, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def nn_dist(sample, cell_type1="sensitive", cell_type2="resistant"):
+    domain = muspan_domain(sample)
     nn = ms.spatial_statistics.nearest_neighbour_distribution(
         domain=domain,
         population_A=("type", cell_type1),
@@ -30,8 +52,8 @@ def nn_dist(df, cell_type1="sensitive", cell_type2="resistant"):
     return nn
 
 
-def cpcf(df, max_radius, annulus_step, annulus_width, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def cpcf(sample, max_radius, annulus_step, annulus_width, cell_type1="sensitive", cell_type2="resistant"):
+    domain = muspan_domain(sample)
     _, pcf = ms.spatial_statistics.cross_pair_correlation_function(
         domain=domain,
         population_A=("type", cell_type1),
@@ -43,8 +65,8 @@ def cpcf(df, max_radius, annulus_step, annulus_width, cell_type1="sensitive", ce
     return pcf
 
 
-def cross_k(df, max_radius, step, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def cross_k(sample, max_radius, step, cell_type1="sensitive", cell_type2="resistant"):
+    domain = muspan_domain(sample)
     _, ck = ms.spatial_statistics.cross_k_function(
         domain=domain,
         population_A=("type", cell_type1),
@@ -55,8 +77,8 @@ def cross_k(df, max_radius, step, cell_type1="sensitive", cell_type2="resistant"
     return ck[1:]
 
 
-def j_function(df, cell_type, radius_step):
-    domain = create_muspan_domain(df)
+def j_function(sample, cell_type, radius_step):
+    domain = muspan_domain(sample)
     _, j, _ = ms.spatial_statistics.J_function(
         domain=domain,
         population=("type", cell_type),
@@ -66,8 +88,8 @@ def j_function(df, cell_type, radius_step):
     return j
 
 
-def anni(df, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def anni(sample, cell_type1="sensitive", cell_type2="resistant"):
+    domain = muspan_domain(sample)
     a, _, _ = ms.spatial_statistics.average_nearest_neighbour_index(
         domain=domain,
         population_A=("type", cell_type1),
@@ -76,8 +98,8 @@ def anni(df, cell_type1="sensitive", cell_type2="resistant"):
     return a
 
 
-def entropy(df):
-    domain = create_muspan_domain(df)
+def entropy(sample):
+    domain = muspan_domain(sample)
     ent = ms.summary_statistics.label_entropy(
         domain=domain,
         label_name="type"
@@ -85,8 +107,8 @@ def entropy(df):
     return ent
 
 
-def qcm(df, side_length):
-    domain = create_muspan_domain(df)
+def qcm(sample, side_length):
+    domain = create_muspan_domain(sample)
     ses, _, _ = ms.region_based.quadrat_correlation_matrix(
         domain,
         label_name="type",
@@ -96,26 +118,23 @@ def qcm(df, side_length):
     return ses[0][1]
 
 
-def global_moransi(df, cell_type, side_length):
-    domain = create_muspan_domain(df)
-    ms.region_based.generate_hexgrid(domain, side_length=side_length,
-                                     regions_collection_name="grids",
-                                     remove_empty_regions=False)
+def global_moransi(sample, cell_type, side_length):
+    domain = derived_domain(sample, "hexgrid", add_hexgrid, side_length=side_length)
     gmi = ms.spatial_statistics.morans_i(domain, population=("Collection", "grids"),
                                          label_name=f"region counts: {cell_type}")
     return gmi[0]
 
 
-def wasserstein(df, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def wasserstein(sample, cell_type1="sensitive", cell_type2="resistant"):
+    domain = muspan_domain(sample)
     wass = ms.distribution.sliced_wasserstein_distance(domain,
                                                        population_A=("type", cell_type1),
                                                        population_B=("type", cell_type2))
     return wass
 
 
-def kl_divergence(df, mesh_step, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def kl_divergence(sample, mesh_step, cell_type1="sensitive", cell_type2="resistant"):
+    domain = muspan_domain(sample)
     kde1 = ms.distribution.kernel_density_estimation(
         domain,
         population=("type", cell_type1),
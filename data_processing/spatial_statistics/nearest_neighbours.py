@@ -0,0 +1,71 @@
+"""Nearest neighbour distribution, ANNI and J-function from shared nearest neighbour queries
+
+Native counterparts of nn_dist, anni and j_function in muspan_statistics. Nearest
+neighbour distances are found with one multithreaded KD-tree query per pair of cell
+types and cached on the sample, so every statistic derived from them reuses the search.
+Like the muspan versions, which only see x and y (see create_muspan_domain), distances
+and the window use the first two coordinates. The window is the bounding box of the sample.
+"""
+
+from math import gamma
+
+import numpy as np
+
+from spatial_egt.data_processing.spatial_statistics.pair_counts import ball_volume, planar, window_volume
+
+
+def nearest_distances(sample, cell_type1="sensitive", cell_type2="resistant", workers=-1):
+    """Distance from each cell of cell_type1 to the nearest other cell of cell_type2"""
+    sample = planar(sample)
+    if sample.count(cell_type2) < (2 if cell_type1 == cell_type2 else 1):
+        raise ValueError(f"Sample has too few {cell_type2} cells.")
+    def build():
+        tree = sample.tree(cell_type2)
+        if cell_type1 == cell_type2:
+            distances, _ = tree.query(sample.coords_of(cell_type1), k=[2], workers=workers)
+            return distances[:, 0]
+        distances, _ = tree.query(sample.coords_of(cell_type1), workers=workers)
+        return distances
+    return sample.cached(("nearest distances", cell_type1, cell_type2), build)
+
+
+def empty_space_distances(sample, cell_type, workers=-1):
+    """Distance from a regular grid of points over the sample to the nearest cell of cell_type
+
+    The grid has about as many points as the sample has cells of cell_type.
+    """
+    sample = planar(sample)
+    def build():
+        mins, maxs = sample.bounds()
+        mins, maxs = mins.astype(float), maxs.astype(float)
+        dims = len(mins)
+        spacing = (window_volume(sample)/max(sample.count(cell_type), 1))**(1/dims)
+        axes = [np.arange(mins[i]+spacing/2, maxs[i], spacing) for i in range(dims)]
+        grid = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, dims)
+        distances, _ = sample.tree(cell_type).query(grid, workers=workers)
+        return distances
+    return sample.cached(("empty space distances", cell_type), build)
+
+
+def nn_dist(sample, cell_type1="sensitive", cell_type2="resistant", workers=-1):
+    return nearest_distances(sample, cell_type1, cell_type2, workers)
+
+
+def anni(sample, cell_type1="sensitive", cell_type2="resistant", workers=-1):
+    """Mean nearest neighbour distance relative to its expectation under complete spatial randomness"""
+    sample = planar(sample)
+    observed = np.mean(nearest_distances(sample, cell_type1, cell_type2, workers))
+    intensity = sample.count(cell_type2)/window_volume(sample)
+    expected = gamma(1+1/2)/(intensity*ball_volume(1, 2))**(1/2)
+    return observed/expected
+
+
+def j_function(sample, cell_type, radius_step, workers=-1):
+    """(1-G)/(1-F) at radii up to the largest empty space distance, where F is still below 1"""
+    sample = planar(sample)
+    nn_distances = np.sort(nearest_distances(sample, cell_type, cell_type, workers))
+    es_distances = np.sort(empty_space_distances(sample, cell_type, workers))
+    radii = np.arange(0, es_distances[-1], radius_step)
+    g = np.searchsorted(nn_distances, radii, side="right")/len(nn_distances)
+    f = np.searchsorted(es_distances, radii, side="right")/len(es_distances)
+    return (1-g)/(1-f)
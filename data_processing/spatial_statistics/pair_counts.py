@@ -0,0 +1,157 @@
+"""Cross-type K and pair correlation functions from edge-corrected pair counts
+
+Native counterparts of cross_k and cpcf in muspan_statistics. Like the muspan versions,
+which only see x and y (see create_muspan_domain), distances and the window use the
+first two coordinates, and the window is the bounding box of the sample. Pairs are
+edge corrected: each pair is weighted by the area of the disk (for K) or annulus (for
+the pair correlation function) around its cell_type1 cell, over the part of that area
+inside the window. The weighted counts of each disk and annulus are found with a
+dual-tree traversal and cached on the sample, so sweeps and both functions share them.
+"""
+
+from math import gamma, pi
+
+import numpy as np
+
+from spatial_egt.data_processing.spatial_statistics.sample import SpatialSample, as_sample
+
+
+def planar(sample):
+    """The sample projected onto x and y, cached on the sample so its pair counts are shared"""
+    sample = as_sample(sample)
+    if len(sample.dimensions) == 2:
+        return sample
+    return sample.cached(("planar",), lambda: SpatialSample(sample.coords[:, :2], sample.types,
+                                                          sample.type_names, sample.dimensions[:2]))
+
+
+def ball_volume(radius, dims):
+    return pi**(dims/2)/gamma(dims/2+1)*np.asarray(radius, dtype=float)**dims
+
+
+def window_volume(sample):
+    mins, maxs = sample.bounds()
+    return float(np.prod(maxs.astype(float) - mins.astype(float)))
+
+
+def window(sample):
+    mins, maxs = sample.bounds()
+    return mins.astype(float), maxs.astype(float)
+
+
+def disk_window_area(points, radius, lower, upper):
+    """Area of the disk of radius around each 2D point that lies inside the box lower to upper"""
+    if radius <= 0:
+        return np.zeros(len(points))
+    def primitive(u):
+        # integral of the half chord length sqrt(radius^2 - u^2)
+        u = np.clip(u, -radius, radius)
+        return (u*np.sqrt(radius**2 - u**2) + radius**2*np.arcsin(u/radius))/2
+    def corner(x, y):
+        # area of the disk centred at the origin with u <= x and v <= y
+        x, y = np.clip(x, -radius, radius), np.clip(y, -radius, radius)
+        t = np.sqrt(radius**2 - y**2)
+        middle = y*(np.clip(x, -t, t) + t) + primitive(np.clip(x, -t, t)) - primitive(-t)
+        sides = (2*(primitive(np.minimum(x, -t)) - primitive(-radius))
+                 + 2*(primitive(np.maximum(x, t)) - primitive(t)))
+        return middle + np.where(y >= 0, sides, 0)
+    x0, y0 = (lower - points).T
+    x1, y1 = (upper - points).T
+    return corner(x1, y1) - corner(x0, y1) - corner(x1, y0) + corner(x0, y0)
+
+
+def edge_weights(points, inner, outer, lower, upper):
+    """Area of the annulus around each point over its area inside the window
+
+    The annulus is inner < distance <= outer, or the disk of radius outer if inner is negative.
+    """
+    inner = max(inner, 0)
+    inside = (disk_window_area(points, outer, lower, upper)
+              - disk_window_area(points, inner, lower, upper))
+    with np.errstate(divide="ignore"):
+        return pi*(outer**2 - inner**2)/inside
+
+
+def count_annuli(cell_tree, target_tree, annuli, lower, upper, edge_correction=True):
+    """Number of targets in each annulus around the cells, summed with the cells' edge weights"""
+    counts = []
+    for inner, outer in annuli:
+        weights = None
+        if edge_correction:
+            weights = (edge_weights(cell_tree.data, inner, outer, lower, upper), None)
+        radii = [outer] if inner < 0 else [inner, outer]
+        weighted = cell_tree.count_neighbors(target_tree, radii, weights=weights, cumulative=True)
+        weighted = np.atleast_1d(weighted)
+        counts.append(weighted[-1] - (weighted[0] if inner >= 0 else 0))
+    return np.array(counts, dtype=float)
+
+
+def annulus_pair_counts(sample, annuli, cell_type1="sensitive", cell_type2="resistant",
+                        edge_correction=True, counter=None):
+    """Edge-corrected number of (cell_type1, cell_type2) pairs in each (inner, outer) annulus
+
+    An annulus with a negative inner radius is the disk of its outer radius. Annuli that
+    have not been counted yet are counted with counter(annuli), a dual-tree traversal
+    per annulus over the whole sample by default (see tiling for a tiled counter).
+    """
+    sample = as_sample(sample)
+    if sample.count(cell_type1) == 0 or sample.count(cell_type2) == 0:
+        raise ValueError(f"Sample has no {cell_type1} or no {cell_type2} cells.")
+    known = sample.cached(("pair counts", cell_type1, cell_type2, edge_correction), dict)
+    annuli = [tuple(x) for x in np.asarray(annuli, dtype=float).tolist()]
+    missing = sorted(set(x for x in annuli if x not in known))
+    if len(missing) > 0:
+        if counter is None:
+            counts = count_annuli(sample.tree(cell_type1), sample.tree(cell_type2), missing,
+                                  *window(sample), edge_correction)
+        else:
+            counts = counter(missing)
+        known.update(zip(missing, np.asarray(counts, dtype=float).tolist()))
+    return np.array([known[x] for x in annuli])
+
+
+def cross_k_radii(max_radius, step):
+    return np.arange(step, max_radius+step/2, step)
+
+
+def cpcf_radii(max_radius, annulus_step, annulus_width):
+    """Annulus centres, inner radii and outer radii of cpcf"""
+    radii = np.arange(0, max_radius+annulus_step/2, annulus_step)
+    return radii, np.maximum(radii-annulus_width/2, 0), radii+annulus_width/2
+
+
+def cross_k(sample, max_radius, step, cell_type1="sensitive", cell_type2="resistant",
+            edge_correction=True):
+    sample = planar(sample)
+    radii = cross_k_radii(max_radius, step)
+    annuli = [(-1, r) for r in radii]
+    counts = annulus_pair_counts(sample, annuli, cell_type1, cell_type2, edge_correction)
+    intensity = sample.count(cell_type1)*sample.count(cell_type2)/window_volume(sample)
+    return counts/intensity
+
+
+def cpcf(sample, max_radius, annulus_step, annulus_width, cell_type1="sensitive", cell_type2="resistant",
+         edge_correction=True):
+    sample = planar(sample)
+    _, inner, outer = cpcf_radii(max_radius, annulus_step, annulus_width)
+    annuli = np.stack((inner, outer), axis=1)
+    annulus_counts = annulus_pair_counts(sample, annuli, cell_type1, cell_type2, edge_correction)
+    annulus_volume = ball_volume(outer, 2) - ball_volume(inner, 2)
+    intensity = sample.count(cell_type1)*sample.count(cell_type2)/window_volume(sample)
+    return annulus_counts/(intensity*annulus_volume)
+
+
+def compare_with_muspan(sample, max_radius, step, annulus_step, annulus_width,
+                        cell_type1="sensitive", cell_type2="resistant"):
+    """Largest absolute difference between these functions and the muspan versions"""
+    from spatial_egt.data_processing.spatial_statistics import muspan_statistics
+
+    sample = as_sample(sample)
+    differences = dict()
+    for name, args in (("cross_k", (max_radius, step)),
+                       ("cpcf", (max_radius, annulus_step, annulus_width))):
+        native = globals()[name](sample, *args, cell_type1, cell_type2)
+        reference = np.asarray(getattr(muspan_statistics, name)(sample, *args, cell_type1, cell_type2))
+        length = min(len(native), len(reference))
+        differences[name] = float(np.max(np.abs(native[:length] - reference[:length])))
+    return differences
@@ -0,0 +1,186 @@
+"""Per-type cell count grids shared by the region-based statistics
+
+A CountPyramid holds per-type counts on square grids aligned at the lower corner of
+the sample, with side lengths that are multiples of a base resolution. A coarser grid
+is summed in blocks from the finest grid already built whose side length divides it,
+so quadrat and mesh statistics at several side lengths bin the cells once.
+
+Window counts (as in sfp_dist) use a summed-area table over the distinct cell
+coordinates along each axis, so its size follows the cells rather than the area of
+the sample, or KD-tree range counts when even that table would be much larger than
+the sample.
+"""
+
+from itertools import product
+
+import numpy as np
+from scipy.signal import fftconvolve
+
+from spatial_egt.data_processing.spatial_statistics.sample import as_sample
+
+
+def block_sum(counts, factor):
+    """Sum a (types, ...) count grid over blocks of factor cells along every spatial axis"""
+    pad = [(0, 0)] + [(0, -size % factor) for size in counts.shape[1:]]
+    counts = np.pad(counts, pad)
+    shape = [counts.shape[0]]
+    for size in counts.shape[1:]:
+        shape += [size//factor, factor]
+    return counts.reshape(shape).sum(axis=tuple(range(2, len(shape), 2)))
+
+
+class CountPyramid:
+    """Cell counts of each type on grids of increasing side length"""
+
+    def __init__(self, sample, base=1):
+        self.sample = sample
+        self.base = base
+        mins, maxs = sample.bounds()
+        self.lower = mins.astype(float)
+        self.upper = maxs.astype(float)
+        self.levels = dict()
+
+    def factor(self, side_length):
+        factor = int(round(side_length/self.base))
+        if factor < 1 or not np.isclose(factor*self.base, side_length):
+            raise ValueError(f"Side length {side_length} is not a multiple of {self.base}.")
+        return factor
+
+    def bin_cells(self, factor):
+        size = self.base*factor
+        shape = tuple((np.floor((self.upper - self.lower)/size) + 1).astype(np.int64))
+        index = np.floor((self.sample.coords - self.lower)/size).astype(np.int64)
+        index = np.ravel_multi_index(tuple(index.T), shape)
+        counts = np.zeros((len(self.sample.type_names), np.prod(shape)), dtype=np.int32)
+        np.add.at(counts, (self.sample.types, index), 1)
+        return counts.reshape((len(self.sample.type_names),)+shape)
+
+    def counts(self, side_length):
+        """Counts of shape (types, ...) on the grid with the given side length"""
+        factor = self.factor(side_length)
+        if factor not in self.levels:
+            divisors = [x for x in self.levels if factor % x == 0]
+            if len(divisors) > 0:
+                divisor = max(divisors)
+                self.levels[factor] = block_sum(self.levels[divisor], factor//divisor)
+            else:
+                self.levels[factor] = self.bin_cells(factor)
+        return self.levels[factor]
+
+    def type_counts(self, cell_type, side_length):
+        return self.counts(side_length)[self.sample.type_names.index(cell_type)]
+
+
+def count_pyramid(sample, base=1):
+    sample = as_sample(sample)
+    return sample.cached(("count pyramid", base), lambda: CountPyramid(sample, base))
+
+
+# largest summed-area table for window counts, in entries per cell of the sample
+MAX_TABLE_RATIO = 16
+
+
+def axis_values(sample):
+    """Sorted distinct coordinates of the cells along each axis"""
+    return sample.cached(("axis values",), lambda: [np.unique(x) for x in sample.coords.T])
+
+
+def summed_area(sample, cell_type):
+    """Summed-area table of cell_type over the distinct cell coordinates, or None if too large
+
+    Entry [i, j, ...] holds the number of cells below the i-th distinct x, j-th distinct y, ...
+    """
+    def build():
+        values = axis_values(sample)
+        shape = tuple(len(x)+1 for x in values)
+        if np.prod(shape, dtype=float) > MAX_TABLE_RATIO*max(len(sample), 1):
+            return None
+        coords = sample.coords_of(cell_type)
+        index = tuple(np.searchsorted(x, coords[:, i]) + 1 for i, x in enumerate(values))
+        table = np.zeros(shape, dtype=np.int32)
+        np.add.at(table, index, 1)
+        for axis in range(table.ndim):
+            np.cumsum(table, axis=axis, out=table)
+        return table
+    return sample.cached(("summed area", cell_type), build)
+
+
+def window_counts(sample, cell_type, ld, side_length):
+    """Number of cells of cell_type in each square window from ld to ld+side_length (inclusive)"""
+    sample = as_sample(sample)
+    if sample.count(cell_type) == 0:
+        return np.zeros(len(ld), dtype=np.int64)
+    table = summed_area(sample, cell_type)
+    if table is None:
+        # a window is the ball of its centre in the maximum norm
+        centres = np.asarray(ld, dtype=float) + side_length/2
+        return sample.tree(cell_type).query_ball_point(centres, side_length/2, p=np.inf,
+                                                       return_length=True).astype(np.int64)
+    values = axis_values(sample)
+    starts = np.stack([np.searchsorted(x, ld[:, i], "left") for i, x in enumerate(values)], axis=1)
+    stops = np.stack([np.searchsorted(x, ld[:, i] + side_length, "right")
+                      for i, x in enumerate(values)], axis=1)
+    dims = table.ndim
+    counts = np.zeros(len(ld), dtype=np.int64)
+    for corner in product((0, 1), repeat=dims):
+        index = tuple(stops[:, i] if c else starts[:, i] for i, c in enumerate(corner))
+        sign = -1 if (dims - sum(corner)) % 2 else 1
+        counts += sign*table[index]
+    return counts
+
+
+def correlation(a, b):
+    """Pearson correlation of the rows of a and b"""
+    a = a - a.mean(axis=-1, keepdims=True)
+    b = b - b.mean(axis=-1, keepdims=True)
+    return (a*b).sum(axis=-1)/np.sqrt((a**2).sum(axis=-1)*(b**2).sum(axis=-1))
+
+
+def qcm(sample, side_length, cell_type1="sensitive", cell_type2="resistant", permutations=1000):
+    """Standardized effect size of the correlation between quadrat counts of two cell types
+
+    The null distribution relabels the cells of the two types at random, keeping the
+    number of cells in each occupied quadrat, by sampling quadrat counts from a
+    multivariate hypergeometric distribution.
+    """
+    pyramid = count_pyramid(sample)
+    a = pyramid.type_counts(cell_type1, side_length).ravel()
+    b = pyramid.type_counts(cell_type2, side_length).ravel()
+    total = a + b
+    occupied = total > 0
+    a, total = a[occupied], total[occupied]
+    observed = correlation(a, total - a)
+    rng = np.random.default_rng()
+    null_a = rng.multivariate_hypergeometric(total, a.sum(), size=permutations)
+    null = correlation(null_a, total - null_a)
+    return (observed - null.mean())/null.std()
+
+
+def mesh_kde(pyramid, cell_type, mesh_step):
+    """Gaussian KDE of one cell type on the mesh, from FFT convolution of the mesh counts
+
+    The bandwidth along each axis follows Scott's rule.
+    """
+    counts = pyramid.type_counts(cell_type, mesh_step).astype(float)
+    coords = pyramid.sample.coords_of(cell_type).astype(float)
+    dims = coords.shape[1]
+    bandwidths = len(coords)**(-1/(dims+4))*coords.std(axis=0)/mesh_step
+    kernel = np.ones((1,)*dims)
+    for axis, bandwidth in enumerate(bandwidths):
+        radius = max(int(np.ceil(4*bandwidth)), 1)
+        offsets = np.arange(-radius, radius+1)
+        weights = np.exp(-0.5*(offsets/max(bandwidth, 1e-12))**2)
+        shape = [1]*dims
+        shape[axis] = len(offsets)
+        kernel = kernel*weights.reshape(shape)
+    density = np.clip(fftconvolve(counts, kernel, mode="same"), 0, None)
+    return density/density.sum()
+
+
+def kl_divergence(sample, mesh_step, cell_type1="sensitive", cell_type2="resistant"):
+    pyramid = count_pyramid(sample)
+    eps = 1e-12
+    p = mesh_kde(pyramid, cell_type1, mesh_step) + eps
+    q = mesh_kde(pyramid, cell_type2, mesh_step) + eps
+    p, q = p/p.sum(), q/q.sum()
+    return float(np.sum(p*np.log(p/q)))
@@ -0,0 +1,176 @@
+"""Array-backed representation of a processed sample shared by the spatial statistics"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import KDTree
+
+
+CELL_TYPES = ("sensitive", "resistant")
+
+
+class SpatialSample:
+    """Cell coordinates grouped by cell type, with lazily built per-type structures
+
+    Cells are stored sorted by type so the coordinates of each type are a contiguous
+    slice of coords. KD-trees, bounds and any other derived structure are built on
+    first use and cached on the sample, so statistics run on the same sample share them.
+    """
+
+    __slots__ = ("coords", "types", "type_names", "dimensions", "_offsets", "_cache")
+
+    def __init__(self, coords, types, type_names, dimensions):
+        coords = np.asarray(coords)
+        types = np.asarray(types)
+        if np.issubdtype(coords.dtype, np.integer):
+            dtype = np.int32
+        else:
+            dtype = np.float32
+        if np.any(types[1:] < types[:-1]):
+            order = np.argsort(types, kind="stable")
+            coords = coords[order]
+            types = types[order]
+        self.coords = np.ascontiguousarray(coords, dtype=dtype)
+        self.types = np.ascontiguousarray(types, dtype=np.int8)
+        self.type_names = tuple(type_names)
+        self.dimensions = tuple(dimensions)
+        self._offsets = np.searchsorted(self.types, np.arange(len(self.type_names)+1))
+        self._cache = {}
+
+    @classmethod
+    def from_df(cls, df):
+        """Build a sample from a processed dataframe with coordinate columns and a type column"""
+        dimensions = [x for x in df.columns if x != "type"]
+        labels = df["type"].astype(str)
+        other_types = sorted(set(labels.unique()) - set(CELL_TYPES))
+        type_names = CELL_TYPES + tuple(other_types)
+        types = pd.Categorical(labels, categories=type_names).codes
+        return cls(df[dimensions].to_numpy(), types, type_names, dimensions)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _type_slice(self, cell_type):
+        if cell_type not in self.type_names:
+            return slice(0, 0)
+        i = self.type_names.index(cell_type)
+        return slice(self._offsets[i], self._offsets[i+1])
+
+    def coords_of(self, cell_type):
+        """Coordinates of every cell of the given type, as a view into coords"""
+        return self.coords[self._type_slice(cell_type)]
+
+    def count(self, cell_type):
+        """Number of cells of the given type"""
+        type_slice = self._type_slice(cell_type)
+        return int(type_slice.stop - type_slice.start)
+
+    @property
+    def counts(self):
+        return {cell_type:self.count(cell_type) for cell_type in self.type_names}
+
+    def labels(self):
+        """Cell type name of every cell, in coords order"""
+        return np.asarray(self.type_names)[self.types]
+
+    def cached(self, key, build):
+        """Return the cached value for key, calling build() to create it on first use"""
+        if key not in self._cache:
+            self._cache[key] = build()
+        return self._cache[key]
+
+    def content_hash(self):
+        """Hash of the coordinates and cell types, identifying samples with the same content"""
+        def build():
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(json.dumps([self.dimensions, self.type_names]).encode())
+            digest.update(self.coords.tobytes())
+            digest.update(self.types.tobytes())
+            return digest.hexdigest()
+        return self.cached("content_hash", build)
+
+    def tree(self, cell_type=None):
+        """KD-tree over the cells of the given type, or over all cells if cell_type is None"""
+        if cell_type is None:
+            return self.cached(("tree", None), lambda: KDTree(self.coords))
+        return self.cached(("tree", cell_type), lambda: KDTree(self.coords_of(cell_type)))
+
+    def bounds(self, cell_type=None):
+        """Minimum and maximum coordinate along each dimension"""
+        def build():
+            coords = self.coords if cell_type is None else self.coords_of(cell_type)
+            return coords.min(axis=0), coords.max(axis=0)
+        return self.cached(("bounds", cell_type), build)
+
+    def to_df(self):
+        df = pd.DataFrame(self.coords, columns=list(self.dimensions))
+        df["type"] = self.labels()
+        return df
+
+
+def as_sample(data):
+    """Return data as a SpatialSample, converting it if it is a processed dataframe"""
+    if isinstance(data, SpatialSample):
+        return data
+    return SpatialSample.from_df(data)
+
+
+def get_cache_path(processed_path):
+    """Directory of the binary cache of the processed samples, next to the processed directory"""
+    return os.path.join(os.path.dirname(os.path.normpath(processed_path)), "processed_cache")
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_sample_cache(sample, stamp, cache_path, name):
+    """Save the sample arrays as .npy files, writing the metadata last to mark the entry complete"""
+    suffix = f".{os.getpid()}.tmp"
+    for array_name in ("coords", "types"):
+        with open(f"{cache_path}/{name}.{array_name}.npy{suffix}", "wb") as f:
+            np.save(f, getattr(sample, array_name))
+        os.replace(f"{cache_path}/{name}.{array_name}.npy{suffix}",
+                   f"{cache_path}/{name}.{array_name}.npy")
+    metadata = {"dimensions":list(sample.dimensions), "type_names":list(sample.type_names),
+                "source":stamp}
+    with open(f"{cache_path}/{name}.json{suffix}", "w", encoding="UTF-8") as f:
+        json.dump(metadata, f)
+    os.replace(f"{cache_path}/{name}.json{suffix}", f"{cache_path}/{name}.json")
+
+
+def read_sample_cache(stamp, cache_path, name):
+    """Memory-map a cached sample, or return None if it is missing or older than its csv"""
+    try:
+        with open(f"{cache_path}/{name}.json", encoding="UTF-8") as f:
+            metadata = json.load(f)
+        if metadata["source"] != stamp:
+            return None
+        coords = np.load(f"{cache_path}/{name}.coords.npy", mmap_mode="r")
+        types = np.load(f"{cache_path}/{name}.types.npy", mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None
+    return SpatialSample(coords, types, metadata["type_names"], metadata["dimensions"])
+
+
+def read_sample(processed_path, file_name):
+    """Read a processed sample, preferring the binary cache if one has been created
+
+    The cache is opt-in: it is used once the processed_cache directory exists
+    (see processed_to_cache). Entries are rebuilt when the csv changes.
+    """
+    csv_path = f"{processed_path}/{file_name}"
+    cache_path = get_cache_path(processed_path)
+    if not os.path.isdir(cache_path):
+        return SpatialSample.from_df(pd.read_csv(csv_path))
+    name = file_name[:-4]
+    stamp = file_stamp(csv_path)
+    sample = read_sample_cache(stamp, cache_path, name)
+    if sample is None:
+        sample = SpatialSample.from_df(pd.read_csv(csv_path))
+        write_sample_cache(sample, stamp, cache_path, name)
+    return sample
@@ -0,0 +1,81 @@
+"""Parameter sweeps that calculate a statistic for several values of one parameter
+
+A sweep is given in STATISTIC_PARAMS as a list of values for one parameter, such as
+{"radius": [1, 2, 3]}, and is saved as one statistic per value, named
+"{statistic name}_{value}". Statistics with a sweep function share the expensive
+step across the values. Other statistics are calculated once per value, in the
+order that lets the structures cached on the sample (pair counts at every radius,
+count pyramid levels) be reused.
+"""
+
+import numpy as np
+
+from spatial_egt.data_processing.spatial_statistics import custom, pair_counts
+from spatial_egt.data_processing.spatial_statistics.sample import as_sample
+
+
+def sweep_parameter(params):
+    """Name and values of the swept parameter, or None if no parameter is a list"""
+    swept = [name for name, value in params.items() if isinstance(value, (list, tuple))]
+    if len(swept) == 0:
+        return None
+    if len(swept) > 1:
+        raise ValueError(f"Only one parameter can be swept, not {', '.join(swept)}.")
+    return swept[0], list(params[swept[0]])
+
+
+def sweep_names(statistic_name, params):
+    """Name of the statistic saved for each value of the sweep"""
+    sweep = sweep_parameter(params)
+    if sweep is None:
+        return [statistic_name]
+    return [f"{statistic_name}_{value}" for value in sweep[1]]
+
+
+def radius_neighbor_counts(tree, points, radii, workers=-1):
+    """Number of tree points within each radius of each point, from one query at the largest radius"""
+    radii = np.asarray(radii, dtype=float)
+    points = np.asarray(points, dtype=float)
+    indices = tree.query_ball_point(points, radii.max(), workers=workers)
+    lengths = np.array([len(x) for x in indices], dtype=np.int64)
+    sources = np.repeat(np.arange(len(points)), lengths)
+    indices = np.concatenate(indices).astype(np.int64) if len(sources) > 0 else sources
+    # compare squared distances, as the tree does, so integer coordinates count exactly
+    distances = np.sum((points[sources] - tree.data[indices])**2, axis=1)
+    bins = np.searchsorted(np.sort(radii**2), distances, side="left")
+    counts = np.bincount(sources*(len(radii)+1) + bins, minlength=len(points)*(len(radii)+1))
+    counts = np.cumsum(counts.reshape(len(points), len(radii)+1), axis=1)[:, :-1]
+    return counts[:, np.argsort(np.argsort(radii))]
+
+
+def nc_dist_sweep(sample, radius, return_fs=True, workers=-1):
+    """nc_dist at every radius from one neighbour query at the largest radius"""
+    sample = as_sample(sample)
+    all_coords = np.concatenate((sample.coords_of("sensitive"), sample.coords_of("resistant")))
+    s_neighbors = radius_neighbor_counts(sample.tree("sensitive"), all_coords, radius, workers)
+    r_neighbors = radius_neighbor_counts(sample.tree("resistant"), all_coords, radius, workers)
+    return [custom.nc_fractions(s_neighbors[:, i], r_neighbors[:, i], sample.count("sensitive"),
+                                return_fs) for i in range(len(radius))]
+
+
+def ordered_sweep(function, sample, parameter, values, params, reverse):
+    """Calculate function once per distinct value, in sorted order"""
+    results = dict()
+    for value in sorted(set(values), reverse=reverse):
+        results[value] = function(sample, **{parameter:value}, **params)
+    return [results[value] for value in values]
+
+
+# pair counts are cached per disk and annulus, so radii shared between values are counted once;
+# other sweeps go smallest first, so coarser count pyramid levels are summed from finer ones
+DESCENDING = {pair_counts.cross_k, pair_counts.cpcf}
+
+
+def calculate_sweep(function, sample, params):
+    """Results of function for each value of the swept parameter, in the order given"""
+    parameter, values = sweep_parameter(params)
+    params = {name:value for name, value in params.items() if name != parameter}
+    if function is custom.nc_dist and parameter == "radius":
+        return nc_dist_sweep(sample, values, **params)
+    sample = as_sample(sample)
+    return ordered_sweep(function, sample, parameter, values, params, function in DESCENDING)
@@ -0,0 +1,231 @@
+"""Tiled calculation of neighbour counts, nearest neighbour distances and pair counts
+
+For samples too large to build KD-trees over every cell, the sample is split into
+square tiles. Each tile is processed on its own with the cells of its core plus a halo
+of the cells within the statistic's radius of the core, so the neighbour counts and
+nearest neighbour distances of the core cells, and the pairs starting from them, are
+exact. Summing or placing the per-tile results gives the same values as the untiled
+statistics. Only the tile order of the cells is held for the whole sample; tiles are
+gathered as workers take them, so peak memory follows the tile size. With the
+processed cache (see processed_to_cache) the coordinates stay memory-mapped.
+
+Nearest neighbour distances and pair counts are stored in the same sample caches as
+the untiled versions, so nn_dist, anni, cross_k and cpcf use them directly.
+"""
+
+from collections.abc import Sequence
+from functools import partial
+from itertools import product
+
+import numpy as np
+from scipy.spatial import KDTree
+
+from spatial_egt.common import parallel_map
+from spatial_egt.data_processing.spatial_statistics import nearest_neighbours, pair_counts
+from spatial_egt.data_processing.spatial_statistics.custom import nc_fractions
+from spatial_egt.data_processing.spatial_statistics.sample import as_sample
+
+
+BLOCK_SIZE = 1 << 20
+
+
+class Tiling:
+    """Assignment of the cells of a sample to square tiles of side tile_length"""
+
+    def __init__(self, sample, tile_length):
+        self.sample = sample
+        self.tile_length = tile_length
+        mins, maxs = sample.bounds()
+        self.lower = mins.astype(float)
+        self.shape = tuple((np.floor((maxs.astype(float) - self.lower)/tile_length) + 1).astype(np.int64))
+        tiles = np.empty(len(sample), dtype=np.int64)
+        for start in range(0, len(sample), BLOCK_SIZE):
+            coords = sample.coords[start:start+BLOCK_SIZE].astype(float)
+            index = np.floor((coords - self.lower)/tile_length).astype(np.int64)
+            tiles[start:start+BLOCK_SIZE] = np.ravel_multi_index(tuple(index.T), self.shape)
+        self.order = np.argsort(tiles, kind="stable")
+        self.offsets = np.searchsorted(tiles[self.order], np.arange(np.prod(self.shape)+1))
+        self.occupied = np.flatnonzero(np.diff(self.offsets))
+
+    def cells(self, tile):
+        return self.order[self.offsets[tile]:self.offsets[tile+1]]
+
+    def tile_data(self, tile, halo):
+        """Core cell indices, core coordinates and types, and halo coordinates and types of a tile
+
+        The halo holds every cell within halo of the tile along each axis, including the core.
+        """
+        core = self.cells(tile)
+        position = np.array(np.unravel_index(tile, self.shape))
+        ring = int(np.ceil(halo/self.tile_length))
+        ranges = [range(max(p-ring, 0), min(p+ring+1, size)) for p, size in zip(position, self.shape)]
+        neighbours = np.ravel_multi_index(tuple(np.array(list(product(*ranges))).T), self.shape)
+        halo_cells = np.sort(np.concatenate([self.cells(x) for x in neighbours]))
+        halo_coords = self.sample.coords[halo_cells]
+        # widen the box slightly so cells on a boundary are never lost to rounding
+        margin = halo + 1e-6*self.tile_length
+        lower = self.lower + position*self.tile_length - margin
+        upper = lower + self.tile_length + 2*margin
+        inside = np.all((halo_coords >= lower) & (halo_coords <= upper), axis=1)
+        return (core, self.sample.coords[core], self.sample.types[core],
+                halo_coords[inside], self.sample.types[halo_cells][inside])
+
+
+class TileTasks(Sequence):
+    """The data of the given tiles with a halo, gathered when each tile is accessed"""
+
+    def __init__(self, tiling, halo, tiles=None):
+        self.tiling = tiling
+        self.halo = halo
+        self.tiles = tiling.occupied if tiles is None else tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.tiling.tile_data(self.tiles[i], self.halo)
+
+
+def get_tiling(sample, tile_length):
+    return sample.cached(("tiling", tile_length), lambda: Tiling(sample, tile_length))
+
+
+def tile_neighbor_counts(radius, num_types, tile):
+    core, core_coords, _, halo_coords, halo_types = tile
+    counts = np.zeros((len(core), num_types), dtype=np.int32)
+    for i in range(num_types):
+        coords = halo_coords[halo_types == i]
+        if len(coords) > 0:
+            counts[:, i] = KDTree(coords).query_ball_point(core_coords, radius, return_length=True)
+    return core, counts
+
+
+def tiled_neighbor_counts(sample, radius, tile_length, workers=1):
+    """Number of cells of each type within radius of every cell (including itself), in coords order"""
+    sample = as_sample(sample)
+    def build():
+        num_types = len(sample.type_names)
+        counts = np.zeros((len(sample), num_types), dtype=np.int32)
+        tasks = TileTasks(get_tiling(sample, tile_length), radius)
+        for core, tile_counts in parallel_map(partial(tile_neighbor_counts, radius, num_types),
+                                              tasks, workers):
+            counts[core] = tile_counts
+        return counts
+    return sample.cached(("neighbor counts", radius), build)
+
+
+def tiled_nc_dist(sample, radius, tile_length, return_fs=True, workers=1):
+    sample = as_sample(sample)
+    counts = tiled_neighbor_counts(sample, radius, tile_length, workers)
+    s_stop = sample.count("sensitive")
+    r_stop = s_stop + sample.count("resistant")
+    return nc_fractions(counts[:r_stop, 0], counts[:r_stop, 1], s_stop, return_fs)
+
+
+def tile_nearest_distances(type1, type2, tile):
+    core, core_coords, core_types, halo_coords, halo_types = tile
+    cells = core[core_types == type1]
+    targets = halo_coords[halo_types == type2]
+    k = 2 if type1 == type2 else 1
+    if len(cells) == 0 or len(targets) < k:
+        return cells, np.full(len(cells), np.inf)
+    distances, _ = KDTree(targets).query(core_coords[core_types == type1], k=[k])
+    return cells, distances[:, 0]
+
+
+def tiled_nearest_distances(sample, tile_length, cell_type1="sensitive", cell_type2="resistant",
+                            halo=None, workers=1):
+    """Distance from each cell of cell_type1 to the nearest other cell of cell_type2
+
+    Tiles whose cells have no neighbour within the halo (tile_length by default) are
+    recalculated with the halo doubled until every distance is within the halo or the
+    halo covers the whole sample.
+    """
+    sample = pair_counts.planar(sample)
+    if sample.count(cell_type2) < (2 if cell_type1 == cell_type2 else 1):
+        raise ValueError(f"Sample has too few {cell_type2} cells.")
+    def build():
+        type1 = sample.type_names.index(cell_type1)
+        type2 = sample.type_names.index(cell_type2)
+        tiling = get_tiling(sample, tile_length)
+        mins, maxs = sample.bounds()
+        diameter = np.linalg.norm(maxs.astype(float) - mins.astype(float))
+        distances = np.full(len(sample), np.inf)
+        tile_halo = tile_length if halo is None else halo
+        tiles = tiling.occupied
+        while len(tiles) > 0:
+            tasks = TileTasks(tiling, tile_halo, tiles)
+            unresolved = []
+            results = parallel_map(partial(tile_nearest_distances, type1, type2), tasks, workers)
+            for tile, (cells, tile_distances) in zip(tiles, results):
+                distances[cells] = tile_distances
+                if np.any(tile_distances > tile_halo):
+                    unresolved.append(tile)
+            if tile_halo >= diameter:
+                break
+            tiles = np.array(unresolved, dtype=np.int64)
+            tile_halo = max(2*tile_halo, tile_length)
+        return distances[sample.types == type1]
+    return sample.cached(("nearest distances", cell_type1, cell_type2), build)
+
+
+def tiled_nn_dist(sample, tile_length, cell_type1="sensitive", cell_type2="resistant", halo=None,
+                  workers=1):
+    sample = pair_counts.planar(sample)
+    tiled_nearest_distances(sample, tile_length, cell_type1, cell_type2, halo, workers)
+    return nearest_neighbours.nn_dist(sample, cell_type1, cell_type2)
+
+
+def tiled_anni(sample, tile_length, cell_type1="sensitive", cell_type2="resistant", halo=None,
+               workers=1):
+    sample = pair_counts.planar(sample)
+    tiled_nearest_distances(sample, tile_length, cell_type1, cell_type2, halo, workers)
+    return nearest_neighbours.anni(sample, cell_type1, cell_type2)
+
+
+def tile_pair_counts(type1, type2, annuli, lower, upper, edge_correction, tile):
+    _, core_coords, core_types, halo_coords, halo_types = tile
+    cells = core_coords[core_types == type1]
+    targets = halo_coords[halo_types == type2]
+    if len(cells) == 0 or len(targets) == 0:
+        return np.zeros(len(annuli))
+    return pair_counts.count_annuli(KDTree(cells), KDTree(targets), annuli, lower, upper, edge_correction)
+
+
+def count_tiled_pairs(sample, tile_length, cell_type1, cell_type2, edge_correction, workers, annuli):
+    # edge weights use the window of the whole sample, not of the tile
+    tasks = TileTasks(get_tiling(sample, tile_length), max(outer for _, outer in annuli))
+    count = partial(tile_pair_counts, sample.type_names.index(cell_type1),
+                    sample.type_names.index(cell_type2), annuli, *pair_counts.window(sample),
+                    edge_correction)
+    return sum(parallel_map(count, tasks, workers))
+
+
+def tiled_pair_counts(sample, annuli, tile_length, cell_type1="sensitive", cell_type2="resistant",
+                      edge_correction=True, workers=1):
+    """annulus_pair_counts, counting each tile's pairs with a halo of the largest radius"""
+    sample = pair_counts.planar(sample)
+    counter = partial(count_tiled_pairs, sample, tile_length, cell_type1, cell_type2, edge_correction,
+                      workers)
+    return pair_counts.annulus_pair_counts(sample, annuli, cell_type1, cell_type2, edge_correction,
+                                           counter)
+
+
+def tiled_cross_k(sample, max_radius, step, tile_length, cell_type1="sensitive",
+                  cell_type2="resistant", edge_correction=True, workers=1):
+    sample = pair_counts.planar(sample)
+    annuli = [(-1, r) for r in pair_counts.cross_k_radii(max_radius, step)]
+    tiled_pair_counts(sample, annuli, tile_length, cell_type1, cell_type2, edge_correction, workers)
+    return pair_counts.cross_k(sample, max_radius, step, cell_type1, cell_type2, edge_correction)
+
+
+def tiled_cpcf(sample, max_radius, annulus_step, annulus_width, tile_length,
+               cell_type1="sensitive", cell_type2="resistant", edge_correction=True, workers=1):
+    sample = pair_counts.planar(sample)
+    _, inner, outer = pair_counts.cpcf_radii(max_radius, annulus_step, annulus_width)
+    tiled_pair_counts(sample, np.stack((inner, outer), axis=1), tile_length,
+                      cell_type1, cell_type2, edge_correction, workers)
+    return pair_counts.cpcf(sample, max_radius, annulus_step, annulus_width, cell_type1, cell_type2,
+                            edge_correction)
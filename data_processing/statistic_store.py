@@ -0,0 +1,64 @@
+"""Saving and loading of calculated statistics
+
+Value statistics are saved as {name}.pkl dataframes with source, sample, {name} and
+type columns. Distribution and function statistics are saved as {name}.ragged
+directories (see ragged.RaggedStatistic) so they can be memory-mapped.
+"""
+
+import os
+import shutil
+
+from pandas.api.types import is_object_dtype
+import pandas as pd
+
+from spatial_egt.data_processing.ragged import RaggedStatistic, save_ragged
+
+
+def statistic_df(rows, statistic_name, statistic_function):
+    """Dataframe of calculated statistic rows, labelled with the statistic type"""
+    df = pd.DataFrame(rows)
+    if is_object_dtype(df[statistic_name]):
+        if statistic_function.__name__.endswith("dist"):
+            df["type"] = "distribution"
+        else:
+            df["type"] = "function"
+    else:
+        df["type"] = "value"
+    return df
+
+
+def statistic_names(statistics_path):
+    """Names of the statistics saved in the directory, excluding the features table"""
+    names = []
+    for file_name in sorted(os.listdir(statistics_path)):
+        if file_name.endswith(".pkl") and file_name != "features.pkl":
+            names.append(file_name[:-4])
+        elif file_name.endswith(".ragged"):
+            names.append(file_name[:-7])
+    return names
+
+
+def save_statistic(df, statistics_path, statistic_name):
+    pkl_path = f"{statistics_path}/{statistic_name}.pkl"
+    ragged_path = f"{statistics_path}/{statistic_name}.ragged"
+    statistic_type = df["type"].iloc[0]
+    if statistic_type == "value":
+        df.to_pickle(pkl_path)
+        if os.path.exists(ragged_path):
+            shutil.rmtree(ragged_path)
+    else:
+        save_ragged(ragged_path, df, statistic_name, statistic_type)
+        if os.path.exists(pkl_path):
+            os.remove(pkl_path)
+
+
+def load_statistic(statistics_path, statistic_name):
+    """Load a statistic as a dataframe (value statistics) or a RaggedStatistic
+
+    Distribution and function statistics from older runs that were pickled are
+    loaded as dataframes too.
+    """
+    ragged_path = f"{statistics_path}/{statistic_name}.ragged"
+    if os.path.exists(ragged_path):
+        return RaggedStatistic(ragged_path)
+    return pd.read_pickle(f"{statistics_path}/{statistic_name}.pkl")
@@ -1,58 +1,71 @@
-import os
-import sys
+import argparse
+from functools import partial
 
 import numpy as np
 import pandas as pd
-from scipy.stats import kurtosis, skew
 
-from spatial_egt.common import get_data_path, read_payoff_df
+from spatial_egt.common import get_data_path, parallel_map, read_payoff_df
+from spatial_egt.data_processing.ragged import (RaggedStatistic, flatten, segment_moments,
+                                                segment_reduce)
+from spatial_egt.data_processing.statistic_store import load_statistic, statistic_names
 
 
-def distribution_to_features(row, name):
-    dist = row[name]
-    row[f"{name}_Mean"] = np.mean(dist)
-    sd = np.std(dist)
-    row[f"{name}_SD"] = sd
-    if sd == 0:
-        row[f"{name}_Skew"] = 0
-        row[f"{name}_Kurtosis"] = 0
+def distribution_to_features(df, name, values, offsets):
+    mean, sd, skew, kurtosis = segment_moments(values, offsets)
+    df[f"{name}_Mean"] = mean
+    df[f"{name}_SD"] = sd
+    df[f"{name}_Skew"] = np.where(sd == 0, 0, skew)
+    df[f"{name}_Kurtosis"] = np.where(sd == 0, 0, kurtosis)
+    return df
+
+
+def function_to_features(df, name, values, offsets):
+    df[f"{name}_Min"] = segment_reduce(np.minimum, values, offsets)
+    df[f"{name}_Max"] = segment_reduce(np.maximum, values, offsets)
+    return df
+
+
+def statistic_to_features(statistic, statistic_name):
+    """Feature columns of a loaded statistic, alongside its source and sample columns"""
+    if isinstance(statistic, RaggedStatistic):
+        df_feature = statistic.keys.copy()
+        statistic_type = statistic.type
+        values, offsets = statistic.values, statistic.offsets
     else:
-        row[f"{name}_Skew"] = skew(dist)
-        row[f"{name}_Kurtosis"] = kurtosis(dist, fisher=True, bias=True)
-    return row
+        statistic_type = statistic["type"].iloc[0]
+        df_feature = statistic.drop("type", axis=1)
+        if statistic_type != "value":
+            values, offsets = flatten(df_feature[statistic_name])
+            df_feature = df_feature.drop(statistic_name, axis=1)
+    if statistic_type == "distribution":
+        df_feature = distribution_to_features(df_feature, statistic_name, values, offsets)
+    elif statistic_type == "function":
+        df_feature = function_to_features(df_feature, statistic_name, values, offsets)
+    df_feature["sample"] = df_feature["sample"].astype(str)
+    return df_feature
 
 
-def function_to_features(row, name):
-    func = row[name]
-    row[f"{name}_Min"] = min(func)
-    row[f"{name}_Max"] = max(func)
-    return row
+def load_statistic_features(statistics_data_path, statistic_name):
+    statistic = load_statistic(statistics_data_path, statistic_name)
+    df_feature = statistic_to_features(statistic, statistic_name)
+    return df_feature.set_index(["source", "sample"])
 
 
-def main(data_type):
+def main(data_type, workers=1):
     processed_data_path = get_data_path(data_type, "processed")
     statistics_data_path = get_data_path(data_type, "statistics")
-    df = read_payoff_df(processed_data_path)[["game"]]
-    for statistic_file in os.listdir(statistics_data_path):
-        if not statistic_file.endswith(".pkl"):
-            continue
-        df_feature = pd.read_pickle(f"{statistics_data_path}/{statistic_file}")
-        statistic_name = statistic_file[:-4]
-        statistic_type = df_feature["type"].iloc[0]
-        if statistic_type == "distribution":
-            df_feature = df_feature.apply(distribution_to_features, axis=1, args=(statistic_name,))
-            df_feature = df_feature.drop(statistic_name, axis=1)
-        elif statistic_type == "function":
-            df_feature = df_feature.apply(function_to_features, axis=1, args=(statistic_name,))
-            df_feature = df_feature.drop(statistic_name, axis=1)
-        df_feature = df_feature.drop("type", axis=1)
-        df_feature["sample"] = df_feature["sample"].astype(str)
-        df = pd.merge(df, df_feature, on=["source", "sample"], how="outer")
+    df_payoff = read_payoff_df(processed_data_path)[["game"]]
+    feature_dfs = list(parallel_map(partial(load_statistic_features, statistics_data_path),
+                                    statistic_names(statistics_data_path), int(workers)))
+    df = pd.concat([df_payoff]+feature_dfs, axis=1, join="outer", sort=True)
+    df = df.rename_axis(["source", "sample"]).reset_index()
     df.to_csv(f"{statistics_data_path}/features.csv", index=False, na_rep=np.nan)
+    df.to_pickle(f"{statistics_data_path}/features.pkl")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        main(sys.argv[1])
-    else:
-        print("Please provide the data type.")
+    parser = argparse.ArgumentParser(description="Calculate features from the saved statistics.")
+    parser.add_argument("data_type", help="the parent data dir")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+    main(args.data_type, args.workers)
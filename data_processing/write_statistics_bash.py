@@ -2,7 +2,7 @@
 
 Expected usage:
 python3 -m spatial_egt.data_processing.write_statistics_bash
-    data_type run_cmd file_name python_file (statistic_names)
+    data_type run_cmd file_name python_file (statistic_name) (num_shards)
 
 Where:
 data_type: the parent data dir
@@ -10,32 +10,75 @@ run_cmd: the command to use for running the spatial statistics, eg python3 or jo
 file_name: name of resulting bash script
 python_file: which file to run, eg processed_to_statistic
 statistic_name: optional
-    if provided the bash script will calculate the spatial statistic separately for each sample
+    if provided the bash script will calculate the spatial statistic separately for shards of samples
     otherwise the bash script will run each spatial statistic over all samples
+num_shards: optional, the number of shards to split the samples into (default 100)
+    samples are packed into shards of about equal estimated cost, from their number of cells,
+    and each shard is one run over a sample list file
 """
 
+import heapq
 import os
 import sys
 
-from spatial_database import STATISTIC_REGISTRY
+from spatial_database import DOMAIN_REGISTRY, STATISTIC_REGISTRY
 from spatial_egt.common import get_data_path
 
 
-def write_individual(run_cmd, python_file, data_type, statistic, file_name):
-    """Write run for each sample of a given spatial statistic"""
+# approximate growth of run time with the number of cells, for calculations that grow
+# faster than linearly (tree searches, pair counts, alpha shapes); others are taken as linear
+# the profiling summary fits these exponents from the profile of previous runs
+COST_EXPONENTS = {"nc_dist":1.1, "nn_dist":1.1, "anni":1.1, "j_function":1.1,
+                  "cross_k":1.2, "cpcf":1.2, "create_patches":1.2}
+
+
+def count_cells(path):
+    """Number of cells in a processed csv, from its number of lines"""
+    lines = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            lines += block.count(b"\n")
+    return max(lines - 1, 0)
+
+
+def estimate_costs(processed_path, sample_files, statistic):
+    """Estimated relative run time of the statistic on each sample"""
+    function = STATISTIC_REGISTRY.get(statistic, DOMAIN_REGISTRY.get(statistic))
+    exponent = COST_EXPONENTS.get(getattr(function, "__name__", None), 1.0)
+    return {x:max(count_cells(f"{processed_path}/{x}"), 1)**exponent for x in sample_files}
+
+
+def pack_shards(costs, num_shards):
+    """Pack samples into shards of about equal total cost, placing the costliest samples first
+
+    Each sample goes to the shard with the lowest total so far (longest processing time
+    first), so every shard also lists its samples from costliest to cheapest.
+    """
+    shards = [[] for _ in range(min(num_shards, len(costs)))]
+    totals = [(0, i) for i in range(len(shards))]
+    for sample_file in sorted(costs, key=costs.get, reverse=True):
+        total, i = heapq.heappop(totals)
+        shards[i].append(sample_file)
+        heapq.heappush(totals, (total + costs[sample_file], i))
+    return shards
+
+
+def write_individual(run_cmd, python_file, data_type, statistic, file_name, num_shards=100):
+    """Write a run over each shard of samples for a given spatial statistic"""
     processed_path = get_data_path(data_type, "processed")
     sample_files = [x for x in os.listdir(processed_path) if x != "payoff.csv"]
+    costs = estimate_costs(processed_path, sample_files, statistic)
     output = []
-    for sample_file in sample_files:
-        source = sample_file.split(" ")[0]
-        sample = sample_file.split(" ")[1][:-4]
-        output.append(f"{run_cmd} {python_file} {data_type} {statistic} {source} {sample}\n")
-    output_batches = [output[i : i + 900] for i in range(0, len(output), 900)]
-    for i, batch in enumerate(output_batches):
-        with open(f"{file_name}_{data_type}_{statistic}_{i}.sh", "w", encoding="UTF-8") as f:
-            for output_line in batch:
-                f.write(output_line)
-    os.mkdir(f"data/{data_type}/features/{statistic}")
+    for i, shard in enumerate(pack_shards(costs, num_shards)):
+        shard_file = f"{file_name}_{data_type}_{statistic}_{i}.txt"
+        with open(shard_file, "w", encoding="UTF-8") as f:
+            for sample_file in shard:
+                f.write(f"{sample_file[:-4]}\n")
+        output.append(f"{run_cmd} {python_file} {data_type} {statistic} --samples {shard_file}\n")
+    with open(f"{file_name}_{data_type}_{statistic}.sh", "w", encoding="UTF-8") as f:
+        for output_line in output:
+            f.write(output_line)
+    get_data_path(data_type, f"statistics/{statistic}")
 
 
 def write_aggregated(run_cmd, python_file, data_type, statistic_names, file_name):
@@ -48,16 +91,16 @@ def write_aggregated(run_cmd, python_file, data_type, statistic_names, file_name
             f.write(output_line)
 
 
-def main(data_type, run_cmd, file_name, python_file, statistic_name=None):
+def main(data_type, run_cmd, file_name, python_file, statistic_name=None, num_shards=100):
     """Generate and save bash script"""
     if statistic_name is None:
         write_aggregated(run_cmd, python_file, data_type, STATISTIC_REGISTRY.keys(), file_name)
     else:
-        write_individual(run_cmd, python_file, data_type, statistic_name, file_name)
+        write_individual(run_cmd, python_file, data_type, statistic_name, file_name, int(num_shards))
 
 
 if __name__ == "__main__":
-    if len(sys.argv) in (5, 6):
+    if len(sys.argv) in (5, 6, 7):
         main(*sys.argv[1:])
     else:
         print("Please see the module docstring for usage instructions.")
@@ -0,0 +1,244 @@
+"""Rebuild the outdated artifacts of a data type, from processed samples to a trained model.
+
+Expected usage:
+python3 -m spatial_egt.pipeline data_type (--jobs J) (--workers W) (--model FEATURES...) (--dry-run)
+
+The stages and their artifacts under data/{data_type} are:
+statistics: statistics/{name}.pkl or .ragged for each registered statistic (processed_to_statistics)
+domains: statistics/{domain}/{sample}.muspan for each registered domain (processed_to_domain)
+domain statistics: statistics/{name} for each domain statistic (domain_to_statistics)
+features: statistics/features.csv and features.pkl (statistics_to_features)
+model input: features/all.csv, the copy of the features read by the classification scripts
+model: images/model/{features}/model.pkl, only if --model is given (classification.model_train)
+
+Like make, a stage runs only if one of its outputs is missing or older than one of its
+inputs (spatial_database.py is an input of every calculation). Statistics and domains
+are calculated with --incremental, so only new or changed samples are recalculated.
+Up to J stages whose inputs are ready run at once, each with W worker processes.
+A summary of the stage times and the critical path is printed at the end.
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import spatial_database
+from spatial_database import DOMAIN_REGISTRY, DOMAIN_STATISTIC_REGISTRY, STATISTIC_REGISTRY
+from spatial_egt.common import get_data_path, select_samples
+from spatial_egt.data_processing.processed_to_statistics import get_output_names, get_statistic_args
+
+
+class Stage:
+    """A command or function that makes output artifacts from input artifacts
+
+    Each input and output is a path, or a tuple of alternative paths of which the
+    newest existing one counts (eg a statistic saved as .pkl or .ragged).
+    """
+
+    def __init__(self, name, inputs, outputs, command=None, function=None, dependencies=(), env=None):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.command = command
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.env = env
+
+    def is_stale(self):
+        output_times = [modified_time(x) for x in self.outputs]
+        if len(output_times) == 0 or None in output_times:
+            return True
+        input_times = [t for t in (modified_time(x) for x in self.inputs) if t is not None]
+        return len(input_times) > 0 and max(input_times) > min(output_times)
+
+    def run(self):
+        if self.function is not None:
+            self.function()
+            return 0
+        return subprocess.run(self.command, env=self.env, check=False).returncode
+
+
+def modified_time(path):
+    """Modification time of a file, or the newest file in a directory, or None if missing"""
+    if isinstance(path, tuple):
+        times = [t for t in (modified_time(x) for x in path) if t is not None]
+        return max(times) if len(times) > 0 else None
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        return max([os.path.getmtime(path)] + [os.path.getmtime(x.path) for x in os.scandir(path)])
+    return os.path.getmtime(path)
+
+
+def module_command(module, *args):
+    return [sys.executable, "-m", f"spatial_egt.{module}"] + [str(x) for x in args]
+
+
+def statistic_artifact(statistics_path, name):
+    return (f"{statistics_path}/{name}.pkl", f"{statistics_path}/{name}.ragged")
+
+
+def build_stages(data_type, workers=1, model_features=None):
+    """The stages of the pipeline for a data type, in dependency order"""
+    processed_path = get_data_path(data_type, "processed")
+    statistics_path = get_data_path(data_type, "statistics")
+    sample_files = select_samples(processed_path)
+    samples = [f"{processed_path}/{x}" for x in sample_files]
+    database = spatial_database.__file__
+    stages = []
+
+    statistic_stages = []
+    statistic_args = get_statistic_args(data_type, list(STATISTIC_REGISTRY))
+    for name in STATISTIC_REGISTRY:
+        outputs = [statistic_artifact(statistics_path, x) for x in get_output_names([name], statistic_args)]
+        command = module_command("data_processing.processed_to_statistics", data_type, name,
+                                 "--incremental", "--workers", workers)
+        statistic_stages.append(Stage(f"statistics {name}", samples+[database], outputs, command))
+
+    for domain_name in DOMAIN_REGISTRY:
+        domain_path = f"{statistics_path}/{domain_name}"
+        domains = [f"{domain_path}/{x[:-4]}.muspan" for x in sample_files]
+        command = module_command("data_processing.processed_to_domain", data_type, domain_name,
+                                 "--incremental", "--workers", workers)
+        domain_stage = Stage(f"domains {domain_name}", samples+[database], domains, command)
+        stages.append(domain_stage)
+        if len(DOMAIN_STATISTIC_REGISTRY) == 0:
+            continue
+        outputs = [statistic_artifact(statistics_path, x) for x in DOMAIN_STATISTIC_REGISTRY]
+        command = module_command("data_processing.domain_to_statistics", data_type, domain_name,
+                                 "--workers", workers)
+        statistic_stages.append(Stage(f"domain statistics {domain_name}", domains+[database], outputs,
+                                      command, dependencies=[domain_stage]))
+    stages += statistic_stages
+
+    features = [f"{statistics_path}/features.csv", f"{statistics_path}/features.pkl"]
+    statistic_outputs = [x for stage in statistic_stages for x in stage.outputs]
+    features_stage = Stage("features", [f"{processed_path}/payoff.csv"]+statistic_outputs, features,
+                           module_command("data_processing.statistics_to_features", data_type,
+                                          "--workers", workers),
+                           dependencies=statistic_stages)
+    stages.append(features_stage)
+
+    model_input = f"{get_data_path(data_type, 'features')}/all.csv"
+    model_input_stage = Stage("model input", features[:1], [model_input],
+                              function=lambda: shutil.copyfile(features[0], model_input),
+                              dependencies=[features_stage])
+    stages.append(model_input_stage)
+
+    if model_features is not None:
+        model_path = f"data/{data_type}/images/model/{'_'.join(model_features)}/model.pkl"
+        command = [sys.executable, "-m", "classification.model_train", data_type] + model_features
+        # the classification scripts import their package from the spatial_egt directory
+        python_path = [os.path.dirname(os.path.abspath(__file__)), os.getcwd(), os.environ.get("PYTHONPATH", "")]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(x for x in python_path if x != ""))
+        stages.append(Stage("model", [model_input], [model_path], command,
+                            dependencies=[model_input_stage], env=env))
+    return stages
+
+
+def run_stages(stages, jobs=1, dry_run=False):
+    """Run the stale stages, up to jobs at once, once their dependencies have finished
+
+    A stage is also run if one of its dependencies was, and skipped if one failed.
+    Returns the seconds taken by each stage that ran (0 for up to date stages) and
+    the names of the stages that failed or were skipped.
+    """
+    durations = dict()
+    rebuilt = set()
+    failed = set()
+    waiting = list(stages)
+    running = dict()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(waiting) > 0 or len(running) > 0:
+            for stage in list(waiting):
+                if any(x in waiting or x in running.values() for x in stage.dependencies):
+                    continue
+                waiting.remove(stage)
+                if any(x.name in failed for x in stage.dependencies):
+                    print(f"Skipping {stage.name}: a dependency failed.")
+                    failed.add(stage.name)
+                elif not (stage.is_stale() or any(x.name in rebuilt for x in stage.dependencies)):
+                    durations[stage.name] = 0
+                elif dry_run:
+                    print(f"Would run {stage.name}.")
+                    durations[stage.name] = 0
+                    rebuilt.add(stage.name)
+                else:
+                    print(f"Running {stage.name}.")
+                    running[executor.submit(timed_run, stage)] = stage
+            if len(running) == 0:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                returncode, seconds = future.result()
+                durations[stage.name] = seconds
+                if returncode == 0:
+                    rebuilt.add(stage.name)
+                    print(f"Finished {stage.name} in {seconds:.1f}s.")
+                else:
+                    failed.add(stage.name)
+                    print(f"Failed {stage.name} (exit code {returncode}) after {seconds:.1f}s.")
+    return durations, failed
+
+
+def timed_run(stage):
+    start = time.perf_counter()
+    try:
+        returncode = stage.run()
+    except Exception as e:
+        print(f"Error: {stage.name}")
+        print(e)
+        returncode = 1
+    return returncode, time.perf_counter() - start
+
+
+def critical_path(stages, durations):
+    """The chain of dependent stages with the longest total time, and that time"""
+    finish = dict()
+    previous = dict()
+    for stage in stages:
+        before = max(stage.dependencies, key=lambda x: finish[x.name], default=None)
+        previous[stage.name] = before
+        finish[stage.name] = durations.get(stage.name, 0) + (0 if before is None else finish[before.name])
+    last = max(stages, key=lambda x: finish[x.name])
+    path = [last]
+    while previous[path[-1].name] is not None:
+        path.append(previous[path[-1].name])
+    return path[::-1], finish[last.name]
+
+
+def main(data_type, jobs=1, workers=1, model_features=None, dry_run=False):
+    start = time.perf_counter()
+    stages = build_stages(data_type, workers, model_features)
+    durations, failed = run_stages(stages, jobs, dry_run)
+    wall_time = time.perf_counter() - start
+    if dry_run:
+        return
+
+    print("\nStage times:")
+    for stage in stages:
+        status = "failed" if stage.name in failed else f"{durations.get(stage.name, 0):.1f}s"
+        print(f"  {stage.name}: {status}")
+    path, path_time = critical_path(stages, durations)
+    print(f"Critical path ({path_time:.1f}s): {' -> '.join(x.name for x in path)}")
+    print(f"Total stage time {sum(durations.values()):.1f}s, wall time {wall_time:.1f}s.")
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the outdated artifacts of a data type.")
+    parser.add_argument("data_type", help="the parent data dir")
+    parser.add_argument("--jobs", type=int, default=1, help="number of stages to run at once")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes for each stage")
+    parser.add_argument("--model", nargs="+", metavar="FEATURES",
+                        help="also train a model on these features (eg all, noncorr, or names)")
+    parser.add_argument("--dry-run", action="store_true", help="only print the stages that would run")
+    args = parser.parse_args()
+    main(args.data_type, args.jobs, args.workers, args.model, args.dry_run)